@@ -36,3 +36,15 @@ class ChargeAdmin(TrackableModelAdminMixin, admin.ModelAdmin):
 class ContractAdmin(admin.ModelAdmin):
     list_display = ('tenant', 'offer', 'item', 'category', 'start_date', 'end_date')
     list_filter = ('tenant', 'category')
+
+
+@admin.register(models.MonthlyCostRollup)
+class MonthlyCostRollupAdmin(admin.ModelAdmin):
+    list_display = ('tenant', 'category', 'month', 'total', 'distinct_users')
+    list_filter = ('tenant', 'category')
+
+
+@admin.register(models.BillingCheckpoint)
+class BillingCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('run', 'tenant', 'start_date', 'end_date', 'users', 'charges_created', 'created')
+    list_filter = ('tenant', 'start_date')
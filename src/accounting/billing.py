@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing
+import time
+import uuid
+from collections import namedtuple
+
+from dateutil.relativedelta import relativedelta
+from django.db import connections, transaction
+
+from catalog.models import Offer
+from provisioning.models import UserProvisionHistory
+from tenants.models import Tenant, User
+
+from models import (
+    BillingCheckpoint, Charge, Contract, ContractIndex, DateFramedModel, MonthlyCostRollup
+    )
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+ShardResult = namedtuple('ShardResult', ['tenant_id', 'users', 'charges', 'elapsed', 'error'])
+
+
+class ChargeEngine(object):
+    def __init__(self, start, end):
+        self.start = DateFramedModel.beginning_of_period(start)
+        self.end = DateFramedModel.end_of_period(end)
+
+    def load_contracts(self, tenants=None):
+        contracts = Contract.objects.filter(
+            start_date__lte=self.end, end_date__gte=self.start
+            ).select_related('offer', 'tenant')
+        if tenants is not None:
+            contracts = contracts.filter(tenant__in=tenants)
+        contracts = list(contracts)
+
+        offers = Offer.objects.filter(
+            id__in=set(c.offer_id for c in contracts)
+            ).select_subclasses()
+        offers = dict((offer.id, offer) for offer in offers)
+        for contract in contracts:
+            contract.offer = offers[contract.offer_id]
+        return ContractIndex(contracts)
+
+    def _billed_months(self, provision_start, provision_end):
+        # Same walk as the original per-entry loop: one charge for every
+        # month touched between the start of the provision (or the billing
+        # window) and its end (or the end of the billing window).
+        current = max(provision_start.date(), self.start)
+        end_interval = self.end if provision_end is None else min(provision_end.date(), self.end)
+        while current < end_interval:
+            yield (
+                DateFramedModel.beginning_of_period(current),
+                DateFramedModel.end_of_period(current)
+                )
+            current += relativedelta(months=1)
+
+    def find_charges(self, entries, index):
+        charges = {}
+        for user_id, tenant_id, item_type_id, object_id, start, end in entries:
+            if start is None:
+                continue
+            for begin_date, end_date in self._billed_months(start, end):
+                contract = index.find(tenant_id, item_type_id, object_id, begin_date, end_date)
+                if contract is None:
+                    log.info('No contract for tenant %s on %s-%s' % (tenant_id, begin_date, end_date))
+                    continue
+                key = (user_id, contract.id, begin_date, end_date)
+                charges.setdefault(key, Charge(
+                    start_date=begin_date,
+                    end_date=end_date,
+                    user_id=user_id,
+                    contract=contract,
+                    amount=contract.offer.monthly_cost,
+                    currency=contract.offer.currency
+                    ))
+        return charges
+
+    def run(self, users, tenants=None):
+        index = self.load_contracts(tenants=tenants)
+        entries = UserProvisionHistory.objects.filter(user__in=users).exclude(
+            end__lt=self.start
+            ).values_list('user_id', 'user__tenant_id', 'item_type_id', 'object_id', 'start', 'end')
+
+        charges = self.find_charges(entries.iterator(), index)
+        recorded = set(Charge.objects.filter(
+            user__in=users, start_date__gte=self.start, start_date__lte=self.end
+            ).values_list('user_id', 'contract_id', 'start_date', 'end_date'))
+        new_charges = [charge for key, charge in charges.items() if key not in recorded]
+
+        with transaction.atomic():
+            Charge.objects.bulk_create(new_charges, batch_size=BATCH_SIZE)
+
+            touched = {}
+            for charge in new_charges:
+                touched.setdefault(charge.contract.tenant, set()).add(charge.start_date)
+            for tenant, months in touched.items():
+                MonthlyCostRollup.objects.refresh(tenant, months)
+
+        log.info('%d charges created, %d already recorded' % (
+            len(new_charges), len(charges) - len(new_charges)
+            ))
+        return new_charges
+
+
+def close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+def new_run():
+    return uuid.uuid4().hex
+
+
+def bill_tenant(args):
+    # Runs in a pool worker: the whole shard commits or rolls back together
+    # with its checkpoint, so an interrupted run can pick up where it failed.
+    run, tenant_id, start, end = args
+    began = time.time()
+    try:
+        engine = ChargeEngine(start, end)
+        with transaction.atomic():
+            users = User.objects.filter(tenant_id=tenant_id)
+            charges = engine.run(users, tenants=[tenant_id])
+            user_count = users.count()
+            BillingCheckpoint.objects.create(
+                run=run,
+                tenant_id=tenant_id,
+                start_date=engine.start,
+                end_date=engine.end,
+                users=user_count,
+                charges_created=len(charges)
+                )
+        return ShardResult(tenant_id, user_count, len(charges), time.time() - began, None)
+    except Exception, why:
+        log.exception('Billing of tenant %s failed' % tenant_id)
+        return ShardResult(tenant_id, 0, 0, time.time() - began, '%s' % why)
+
+
+def bill_tenants(start, end, tenants=None, processes=None, run=None):
+    # Charges already recorded are never created twice, so every run bills
+    # all tenants again. Only when resuming a run (passing its id) are the
+    # tenants it already completed skipped.
+    engine = ChargeEngine(start, end)
+    run = run or new_run()
+    tenants = Tenant.objects.all() if tenants is None else tenants
+    checkpoints = BillingCheckpoint.objects.filter(
+        run=run, start_date=engine.start, end_date=engine.end
+        )
+    tenant_ids = list(tenants.exclude(
+        id__in=checkpoints.values_list('tenant_id', flat=True)
+        ).values_list('id', flat=True))
+    shards = [(run, tenant_id, engine.start, engine.end) for tenant_id in tenant_ids]
+
+    if processes == 1 or len(shards) <= 1:
+        for shard in shards:
+            yield bill_tenant(shard)
+        return
+
+    # Forked workers must not share the parent's database connections.
+    close_connections()
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        for result in pool.imap_unordered(bill_tenant, shards):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
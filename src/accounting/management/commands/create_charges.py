@@ -15,31 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import calendar
-import datetime
-import logging
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from dateutil.parser import parse
-from dateutil.relativedelta import relativedelta
 
-from accounting.models import Contract, Charge
-from tenants.models import User
-
-
-log = logging.getLogger(__name__)
-
-
-def beginning_of_period(date):
-    if date is None: date = datetime.date.today()
-    return datetime.date(year=date.year, month=date.month, day=1)
-
-
-def end_of_period(date):
-    if date is None: date = datetime.date.today()
-    last_day_of_month = calendar.monthrange(date.year, date.month)[1]
-    return datetime.date(year=date.year, month=date.month, day=last_day_of_month)
+from accounting.billing import ChargeEngine, bill_tenants, new_run
+from tenants.models import Tenant, User
 
 
 class Command(BaseCommand):
@@ -48,62 +30,45 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('-s', '--start', dest='start_date', default=None, help='start date'),
         make_option('-e', '--end', dest='end_date', default=None, help='end date'),
-        make_option('-u', '--user', dest='user', default=None, help='username')
+        make_option('-u', '--user', dest='user', default=None, help='username'),
+        make_option('-t', '--tenant', dest='tenant', default=None, help='tenant name'),
+        make_option(
+            '-p', '--processes', dest='processes', type='int', default=None,
+            help='number of worker processes (defaults to the number of cpus)'
+            ),
+        make_option(
+            '-r', '--resume', dest='run', default=None,
+            help='id of an interrupted run, to skip the tenants it completed'
+            )
     )
 
-    def find_charges(self, provision, start, end):
-        item = provision.item
-        user = provision.user
-
-        # we want to find all charges that one provision action incurs
-        # between the period of start and end.
-
-        # We start by finding the earliest point that dates to be looked at.
-        begin_interval = max(provision.start.date(), start)
-        end_interval = end if provision.end is None else min(provision.end.date(), end)
-
-        current = begin_interval
-
-        # For each month in the begin_interval/end_interval period, we
-        # find the contract and record the charge
-
-        while current < end_interval:
-            begin_date = beginning_of_period(current)
-            end_date = end_of_period(current)
-            contract = Contract.objects.valid_offer_for_item(
-                user.tenant, item, begin_date, end_date
-                )
-
-            if contract is None:
-                log.info('No contract for %s on %s-%s' % (user.tenant, begin_date, end_date))
-                continue
-
-            offer = contract.offer.__subclassed__
-            charge, created = Charge.objects.get_or_create(
-                start_date=begin_date,
-                end_date=end_date,
-                user=user,
-                contract=contract,
-                amount=offer.monthly_cost,
-                currency=offer.currency
-                )
-
-            current += relativedelta(months=1)
-
-            if created:
-                log.info('%s created' % charge)
-            else:
-                log.info('%s already recorded' % charge)
-
     def handle(self, *fixture_labels, **opts):
-        start = beginning_of_period(opts['start_date'] and parse(opts['start_date']).date())
-        end = end_of_period(opts['end_date'] and parse(opts['end_date']).date())
+        start = opts['start_date'] and parse(opts['start_date']).date()
+        end = opts['end_date'] and parse(opts['end_date']).date()
         username = opts.get('user')
 
-        users = User.objects.all()
-
-        if username: users = users.filter(username=username)
-
-        for user in users:
-            for entry in user.userprovisionhistory_set.exclude(end__lt=start):
-                self.find_charges(entry, start, end)
+        if username:
+            charges = ChargeEngine(start, end).run(User.objects.filter(username=username))
+            self.stdout.write('%d charges created' % len(charges))
+            return
+
+        tenants = Tenant.objects.all()
+        if opts.get('tenant'): tenants = tenants.filter(name=opts['tenant'])
+
+        run = opts['run'] or new_run()
+        self.stdout.write('Billing run %s' % run)
+        failed = []
+        for shard in bill_tenants(start, end, tenants, opts['processes'], run):
+            if shard.error:
+                failed.append(shard.tenant_id)
+                self.stderr.write('Tenant %s failed: %s' % (shard.tenant_id, shard.error))
+                continue
+            self.stdout.write('Tenant %s: %d users, %d charges in %.1fs (%.1f users/s)' % (
+                shard.tenant_id, shard.users, shard.charges, shard.elapsed,
+                shard.users / shard.elapsed if shard.elapsed else 0
+                ))
+
+        if failed:
+            raise CommandError('Billing failed for tenants %s, resume with --resume %s' % (
+                ', '.join(map(str, failed)), run
+                ))
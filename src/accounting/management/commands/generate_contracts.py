@@ -66,10 +66,11 @@ class Command(BaseCommand):
         start_date = Contract.beginning_of_period(year_ago)
         end_date = Contract.end_of_period(year_from_now)
 
-        for tenant in Tenant.objects.all():
-            for service in tenant.tenantservice_set.select_subclasses():
-                make_contract(make_offer(service), tenant, start_date, end_date)
-
-            for asset in Asset.objects.filter(tenantasset__tenant=tenant).select_subclasses():
-                log.info('Checking/Creating contracts for %s' % asset)
-                make_contract(make_offer(asset), tenant, start_date, end_date)
+        with Contract.objects.indexed():
+            for tenant in Tenant.objects.all():
+                for service in tenant.tenantservice_set.select_subclasses():
+                    make_contract(make_offer(service), tenant, start_date, end_date)
+
+                for asset in Asset.objects.filter(tenantasset__tenant=tenant).select_subclasses():
+                    log.info('Checking/Creating contracts for %s' % asset)
+                    make_contract(make_offer(asset), tenant, start_date, end_date)
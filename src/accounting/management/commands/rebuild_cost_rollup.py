@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from accounting.models import MonthlyCostRollup
+from tenants.models import Tenant
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the monthly cost rollup from the recorded charges'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-t', '--tenant', dest='tenant', default=None, help='tenant id'),
+    )
+
+    def handle(self, *fixture_labels, **opts):
+        tenants = Tenant.objects.all()
+
+        if opts.get('tenant'): tenants = tenants.filter(pk=opts['tenant'])
+
+        for tenant in tenants:
+            MonthlyCostRollup.objects.rebuild(tenant)
+            log.info('Rebuilt cost rollup for %s' % tenant)
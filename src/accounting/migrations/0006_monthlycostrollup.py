@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.db import models, migrations
+
+
+def populate_rollup(apps, schema_editor):
+    Charge = apps.get_model('accounting', 'Charge')
+    MonthlyCostRollup = apps.get_model('accounting', 'MonthlyCostRollup')
+
+    cells = {}
+    charges = Charge.objects.values_list(
+        'user__tenant', 'contract__category', 'start_date', 'end_date', 'user', 'amount'
+    )
+    for tenant, category, start_date, end_date, user, amount in charges.iterator():
+        month = datetime.date(start_date.year, start_date.month, 1)
+        while month <= end_date:
+            cell = cells.setdefault((tenant, category, month), [0, set()])
+            cell[0] += amount
+            cell[1].add(user)
+            month += relativedelta(months=1)
+
+    MonthlyCostRollup.objects.bulk_create([
+        MonthlyCostRollup(
+            tenant_id=tenant,
+            category=category,
+            month=month,
+            total=total,
+            distinct_users=len(users)
+        ) for (tenant, category, month), (total, users) in cells.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0001_initial'),
+        ('accounting', '0005_auto_20141203_1112'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyCostRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('category', models.CharField(max_length=50, choices=[(b'platform', b'platform'), (b'software', b'software'), (b'devices', b'devices'), (b'other', b'other')])),
+                ('month', models.DateField()),
+                ('total', models.DecimalField(max_digits=14, decimal_places=2)),
+                ('distinct_users', models.PositiveIntegerField(default=0)),
+                ('tenant', models.ForeignKey(to='tenants.Tenant')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlycostrollup',
+            unique_together=set([('tenant', 'category', 'month')]),
+        ),
+        migrations.RunPython(populate_rollup),
+    ]
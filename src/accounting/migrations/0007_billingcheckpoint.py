@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0001_initial'),
+        ('accounting', '0006_monthlycostrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('users', models.PositiveIntegerField(default=0)),
+                ('charges_created', models.PositiveIntegerField(default=0)),
+                ('tenant', models.ForeignKey(to='tenants.Tenant')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='billingcheckpoint',
+            unique_together=set([('tenant', 'start_date', 'end_date')]),
+        ),
+    ]
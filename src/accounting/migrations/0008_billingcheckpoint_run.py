@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0001_initial'),
+        ('accounting', '0007_billingcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingcheckpoint',
+            name='run',
+            field=models.CharField(default='', max_length=32, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='billingcheckpoint',
+            unique_together=set([('run', 'tenant', 'start_date', 'end_date')]),
+        ),
+    ]
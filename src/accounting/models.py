@@ -15,10 +15,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import calendar
 import datetime
+import threading
+from contextlib import contextmanager
 
+from dateutil.relativedelta import relativedelta
 from django.db import models
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.signals import post_delete, post_save
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from model_utils import Choices
@@ -55,16 +62,104 @@ class DateFramedModel(models.Model):
         abstract = True
 
 
+def month_periods(start, end):
+    current = DateFramedModel.beginning_of_period(start)
+    while current <= end:
+        yield current, DateFramedModel.end_of_period(current)
+        current += relativedelta(months=1)
+
+
+class ContractIndex(object):
+    # In-memory lookup of contracts by (tenant, item type, item id). Contracts
+    # of one item are kept sorted by start date, so finding the one valid in
+    # a period is a binary search instead of a database query. An index that
+    # is not complete holds only some of the contracts, so a miss in it is
+    # not final.
+    def __init__(self, contracts=(), complete=True):
+        self.complete = complete
+        self._entries = {}
+        self._keys = {}
+        for contract in contracts:
+            self.add(contract)
+
+    @staticmethod
+    def _key(tenant_id, item_type_id, object_id):
+        return (tenant_id, item_type_id, object_id)
+
+    def _store(self, key, contracts):
+        if not contracts:
+            self._entries.pop(key, None)
+            return
+        contracts.sort(key=lambda c: c.start_date)
+        latest_ends = []
+        for c in contracts:
+            latest_ends.append(max(c.end_date, latest_ends[-1]) if latest_ends else c.end_date)
+        self._entries[key] = ([c.start_date for c in contracts], latest_ends, contracts)
+
+    def add(self, contract):
+        self.remove(contract)
+        key = self._key(contract.tenant_id, contract.offer.item_type_id, contract.offer.object_id)
+        self._keys[contract.pk] = key
+        self._store(key, self._entries.get(key, ([], [], []))[2] + [contract])
+
+    def remove(self, contract):
+        key = self._keys.pop(contract.pk, None)
+        if key in self._entries:
+            self._store(key, [c for c in self._entries[key][2] if c.pk != contract.pk])
+
+    def find(self, tenant_id, item_type_id, object_id, start_date, end_date):
+        starts, latest_ends, contracts = self._entries.get(
+            self._key(tenant_id, item_type_id, object_id), ([], [], [])
+            )
+        idx = bisect.bisect_right(starts, end_date) - 1
+        while idx >= 0 and latest_ends[idx] >= start_date:
+            if contracts[idx].end_date >= start_date:
+                return contracts[idx]
+            idx -= 1
+        return None
+
+
+_index_scope = threading.local()
+
+
 class ContractQuerySet(models.QuerySet):
-    def valid_offer_for_item(self, tenant, item, start_date, end_date):
+    def _is_unfiltered(self):
+        return not self.query.where and self.query.can_filter()
+
+    @contextmanager
+    def indexed(self):
+        # Within this block, contract lookups are answered from an index of
+        # the contracts in this queryset instead of querying for every call.
+        # Contracts saved or deleted meanwhile are kept up to date in it.
+        previous = getattr(_index_scope, 'index', None)
+        _index_scope.index = ContractIndex(
+            self.select_related('offer'), complete=self._is_unfiltered()
+            )
         try:
-            return self.filter(
-                tenant=tenant,
-                offer__item_type=ContentType.objects.get_for_model(item),
-                offer__object_id=item.id
-                ).exclude(start_date__gte=end_date, end_date__lte=start_date).get()
-        except self.model.DoesNotExist:
-            return None
+            yield _index_scope.index
+        finally:
+            _index_scope.index = previous
+
+    def valid_contract(self, tenant_id, item_type_id, object_id, start_date, end_date):
+        # The index only stands in for lookups on all contracts; lookups on a
+        # filtered queryset, and misses of an incomplete index, are queried.
+        index = getattr(_index_scope, 'index', None)
+        if index is not None and self._is_unfiltered():
+            contract = index.find(tenant_id, item_type_id, object_id, start_date, end_date)
+            if contract is not None or index.complete:
+                return contract
+        return self.filter(
+            tenant_id=tenant_id,
+            offer__item_type_id=item_type_id,
+            offer__object_id=object_id,
+            start_date__lte=end_date,
+            end_date__gte=start_date
+            ).order_by('-start_date').first()
+
+    def valid_offer_for_item(self, tenant, item, start_date, end_date):
+        return self.valid_contract(
+            tenant.id, ContentType.objects.get_for_model(item).id, item.id, start_date, end_date
+            )
 
 
 class Contract(DateFramedModel):
@@ -86,8 +181,9 @@ class Contract(DateFramedModel):
         return getattr(obj.__class__, 'EXPENSE_CATEGORY', CATEGORY_CHOICES.other)
 
     def validate_unique(self, exclude=None):
-        item_contract = self.__class__.objects.valid_offer_for_item(
-            self.tenant, self.item, self.start_date, self.end_date
+        item_contract = self.__class__.objects.valid_contract(
+            self.tenant_id, self.offer.item_type_id, self.offer.object_id,
+            self.start_date, self.end_date
             )
 
         if item_contract is not None and item_contract.pk != self.pk:
@@ -96,13 +192,61 @@ class Contract(DateFramedModel):
 
     def save(self, *args, **kw):
         self.validate_unique()
-        return super(DateFramedModel, self).save(*args, **kw)
+        result = super(DateFramedModel, self).save(*args, **kw)
+        index = getattr(_index_scope, 'index', None)
+        if index is not None:
+            index.add(self)
+        return result
+
+    def delete(self, *args, **kw):
+        index = getattr(_index_scope, 'index', None)
+        if index is not None:
+            index.remove(self)
+        return super(Contract, self).delete(*args, **kw)
 
     def __unicode__(self):
         return 'Contract for %s on %s' % (self.tenant, self.item)
 
 
+class ChargeQuerySet(models.QuerySet):
+    def in_period(self, start, end):
+        return self.exclude(start_date__gt=end).exclude(end_date__lt=start)
+
+    def monthly_costs(self, periods):
+        # Returns {(category, period_start): (total, distinct users)} for the
+        # given (start, end) periods out of a single grouped query. A charge
+        # counts for every period it overlaps; distinct users are only
+        # recounted when charges of different lengths share a period.
+        periods = list(periods)
+        if not periods:
+            return {}
+
+        groups = self.in_period(periods[0][0], periods[-1][1]).values(
+            'contract__category', 'start_date', 'end_date'
+            ).annotate(total=Sum('amount'), users=Count('user', distinct=True)).order_by()
+
+        cells = {}
+        for group in groups:
+            for start, end in periods:
+                if group['start_date'] <= end and group['end_date'] >= start:
+                    cells.setdefault((group['contract__category'], start), []).append(group)
+
+        costs = {}
+        for (category, start), cell_groups in cells.items():
+            total = sum(group['total'] for group in cell_groups)
+            if len(cell_groups) == 1:
+                users = cell_groups[0]['users']
+            else:
+                end = dict(periods)[start]
+                users = self.filter(contract__category=category).in_period(
+                    start, end).values('user').distinct().count()
+            costs[(category, start)] = (total, users)
+        return costs
+
+
 class Charge(TimeStampedModel, DateFramedModel):
+    objects = models.Manager.from_queryset(ChargeQuerySet)()
+
     user = models.ForeignKey(User, editable=False)
     contract = models.ForeignKey(Contract, editable=False)
     amount = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
@@ -116,7 +260,118 @@ class Charge(TimeStampedModel, DateFramedModel):
     def category(self):
         return self.contract.category
 
+    @staticmethod
+    def on_change(*args, **kw):
+        # Charges saved or deleted one by one refresh the rollup rows of
+        # their category in the months they cover; billing runs bulk create
+        # theirs and refresh once. Deleting charges never creates rows, so
+        # charges deleted along with their tenant leave nothing behind.
+        charge = kw.get('instance')
+        if kw.get('raw'):
+            return
+        MonthlyCostRollup.objects.refresh_category(
+            charge.contract.tenant_id, charge.contract.category,
+            [start for start, end in month_periods(charge.start_date, charge.end_date)],
+            create=kw.get('signal') is post_save
+            )
+
     def __unicode__(self):
         return 'Charge on %s (%s) for %s on %s to %s' % (
             self.user, self.user.tenant, self.item, self.start_date, self.end_date
             )
+
+
+class MonthlyCostRollupQuerySet(models.QuerySet):
+    def costs(self, tenant, periods):
+        months = [start for start, end in periods]
+        return dict(
+            ((r.category, r.month), (r.total, r.distinct_users))
+            for r in self.filter(tenant=tenant, month__in=months)
+            )
+
+    def refresh(self, tenant, months):
+        periods = [
+            (month, DateFramedModel.end_of_period(month))
+            for month in sorted(set(DateFramedModel.beginning_of_period(m) for m in months))
+            ]
+        costs = Charge.objects.filter(user__tenant=tenant).monthly_costs(periods)
+        with transaction.atomic():
+            self.filter(tenant=tenant, month__in=[start for start, end in periods]).delete()
+            self.bulk_create([
+                self.model(
+                    tenant=tenant,
+                    category=category,
+                    month=month,
+                    total=total,
+                    distinct_users=users
+                    ) for (category, month), (total, users) in costs.items()
+                ])
+
+    def refresh_category(self, tenant_id, category, months, create=True):
+        periods = [
+            (month, DateFramedModel.end_of_period(month))
+            for month in sorted(set(DateFramedModel.beginning_of_period(m) for m in months))
+            ]
+        costs = Charge.objects.filter(
+            user__tenant_id=tenant_id, contract__category=category
+            ).monthly_costs(periods)
+        with transaction.atomic():
+            for month, end in periods:
+                rows = self.filter(tenant_id=tenant_id, category=category, month=month)
+                if (category, month) not in costs:
+                    rows.delete()
+                    continue
+                total, users = costs[(category, month)]
+                if not rows.update(total=total, distinct_users=users) and create:
+                    self.create(
+                        tenant_id=tenant_id, category=category, month=month,
+                        total=total, distinct_users=users
+                        )
+
+    def rebuild(self, tenant):
+        charges = Charge.objects.filter(user__tenant=tenant).aggregate(
+            first=Min('start_date'), last=Max('end_date')
+            )
+        with transaction.atomic():
+            self.filter(tenant=tenant).delete()
+            if charges['first'] is not None:
+                self.refresh(tenant, [
+                    start for start, end in month_periods(charges['first'], charges['last'])
+                    ])
+
+
+class MonthlyCostRollup(models.Model):
+    objects = models.Manager.from_queryset(MonthlyCostRollupQuerySet)()
+
+    tenant = models.ForeignKey(Tenant)
+    category = models.CharField(max_length=50, choices=CATEGORY_CHOICES)
+    month = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2)
+    distinct_users = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return '%s costs for %s on %s' % (self.category, self.tenant, self.month.strftime('%Y-%m'))
+
+    class Meta:
+        unique_together = ('tenant', 'category', 'month')
+
+
+class BillingCheckpoint(TimeStampedModel):
+    # Marks a tenant as done within one billing run, so that the run can be
+    # resumed after an interruption. New runs bill every tenant again.
+    run = models.CharField(max_length=32, db_index=True, default='')
+    tenant = models.ForeignKey(Tenant)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    users = models.PositiveIntegerField(default=0)
+    charges_created = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return 'Billing of %s for %s-%s' % (self.tenant, self.start_date, self.end_date)
+
+    class Meta:
+        unique_together = ('run', 'tenant', 'start_date', 'end_date')
+
+
+post_save.connect(Charge.on_change, dispatch_uid='charge_save', sender=Charge)
+post_delete.connect(Charge.on_change, dispatch_uid='charge_delete', sender=Charge)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import models as django_models
+from django.db.models import Sum
+from django.test import TestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from catalog.factories import SubscriptionFactory
+from provisioning.factories import AssetFactory
+from provisioning.models import Okta, UserProvisionHistory
+from tenants.factories import TenantFactory, UserFactory
+
+import billing
+import factories
+import models
+import views
+
+
+def make_contract(tenant, category, start_date, end_date):
+    asset = AssetFactory()
+    offer = SubscriptionFactory(
+        item_type=ContentType.objects.get_for_model(asset), object_id=asset.id
+        )
+    return factories.ContractFactory(
+        tenant=tenant, offer=offer, category=category, start_date=start_date, end_date=end_date
+        )
+
+
+def month(year, month_number):
+    start = datetime.date(year, month_number, 1)
+    return start, models.Charge.end_of_period(start)
+
+
+class CostViewTestCase(TestCase):
+    def setUp(self):
+        self.tenant = TenantFactory()
+        self.users = []
+        for idx in xrange(3):
+            user = UserFactory.build(tenant=self.tenant, username='user%d' % idx)
+            django_models.Model.save(user)
+            self.users.append(user)
+
+        year_start, year_end = datetime.date(2014, 1, 1), datetime.date(2014, 12, 31)
+        software = make_contract(self.tenant, 'software', year_start, year_end)
+        devices = make_contract(self.tenant, 'devices', year_start, year_end)
+
+        for month_number in xrange(1, 7):
+            start, end = month(2014, month_number)
+            for user in self.users[:month_number % 3 + 1]:
+                self._charge(user, software, start, end, Decimal('9.99'))
+            self._charge(self.users[0], devices, start, end, Decimal('20.00'))
+
+        # A charge spanning several months shares periods with monthly ones
+        self._charge(
+            self.users[1], devices, datetime.date(2014, 2, 1), datetime.date(2014, 4, 30),
+            Decimal('45.50')
+            )
+        models.MonthlyCostRollup.objects.rebuild(self.tenant)
+
+    def _charge(self, user, contract, start, end, amount):
+        models.Charge.objects.create(
+            user=user, contract=contract, start_date=start, end_date=end,
+            amount=amount, currency='EUR'
+            )
+
+    def _get(self, view_class):
+        request = APIRequestFactory().get('/', {'start': '2014-01', 'end': '2014-08'})
+        force_authenticate(request, user=self.tenant.primary_contact)
+        return view_class.as_view()(request).data
+
+    def _expected(self, per_user):
+        charges = models.Charge.objects.filter(user__tenant=self.tenant)
+        expected = {}
+        for category in models.EXPENSE_CATEGORIES:
+            expected[category] = []
+            for month_number in xrange(1, 9):
+                start, end = month(2014, month_number)
+                cell = charges.filter(contract__category=category).exclude(
+                    start_date__gt=end).exclude(end_date__lt=start)
+                total = cell.aggregate(total=Sum('amount')).get('total') or 0
+                if per_user:
+                    users = cell.values('user').distinct().count()
+                    total = 0 if not users else total / users
+                expected[category].append({
+                    'date': '2014-%02d' % month_number, 'cost': round(total, 2)
+                    })
+        return expected
+
+    def testChargesCostMatchesPerPeriodAggregation(self):
+        self.assertEqual(self._get(views.ChargesCostView), self._expected(per_user=False))
+
+    def testUserCostMatchesPerPeriodAggregation(self):
+        self.assertEqual(self._get(views.UserCostView), self._expected(per_user=True))
+
+    def testRollupRefreshPicksUpNewCharges(self):
+        start, end = month(2014, 7)
+        contract = models.Contract.objects.filter(category='software').get()
+        for user in self.users:
+            self._charge(user, contract, start, end, Decimal('9.99'))
+        models.MonthlyCostRollup.objects.refresh(self.tenant, [start])
+        self.assertEqual(self._get(views.UserCostView), self._expected(per_user=True))
+
+    def testRollupFollowsChargesSavedAndDeleted(self):
+        start, end = month(2014, 8)
+        contract = models.Contract.objects.filter(category='devices').get()
+        self._charge(self.users[2], contract, start, end, Decimal('20.00'))
+        self.assertEqual(self._get(views.ChargesCostView), self._expected(per_user=False))
+
+        models.Charge.objects.filter(user=self.users[1], end_date=datetime.date(2014, 4, 30)).get().delete()
+        self.assertEqual(self._get(views.UserCostView), self._expected(per_user=True))
+
+    def testRollupFollowsDeletedUsers(self):
+        django_models.Model.delete(self.users[1])
+        self.assertEqual(self._get(views.ChargesCostView), self._expected(per_user=False))
+        self.assertEqual(self._get(views.UserCostView), self._expected(per_user=True))
+
+    def testTenantsAreDeletedWithTheirCharges(self):
+        self.tenant.delete()
+        self.assertFalse(models.MonthlyCostRollup.objects.exists())
+        self.assertFalse(models.Charge.objects.exists())
+
+
+class ChargeEngineTestCase(TestCase):
+    def setUp(self):
+        self.tenant = TenantFactory()
+        self.user = UserFactory.build(tenant=self.tenant, username='user')
+        django_models.Model.save(self.user)
+        self.service = Okta.objects.create(tenant=self.tenant, api_token='token', domain='example')
+
+        self.contract = make_contract(
+            self.tenant, 'software', datetime.date(2014, 1, 1), datetime.date(2014, 3, 31)
+            )
+        self.renewal = factories.ContractFactory(
+            tenant=self.tenant, offer=self.contract.offer, category='software',
+            start_date=datetime.date(2014, 4, 1), end_date=datetime.date(2014, 12, 31)
+            )
+        asset = self.contract.offer.item
+        UserProvisionHistory.objects.create(
+            user=self.user, service=self.service,
+            item_type=ContentType.objects.get_for_model(asset), object_id=asset.id,
+            start=datetime.datetime(2014, 2, 15), end=None
+            )
+
+    def _run(self):
+        engine = billing.ChargeEngine(datetime.date(2014, 1, 1), datetime.date(2014, 6, 1))
+        return engine.run(models.User.objects.filter(pk=self.user.pk))
+
+    def testChargesEveryMonthAgainstTheValidContract(self):
+        self._run()
+        charges = models.Charge.objects.order_by('start_date')
+        self.assertEqual(
+            [(c.start_date.month, c.contract_id) for c in charges],
+            [(2, self.contract.id), (3, self.contract.id)] +
+            [(month_number, self.renewal.id) for month_number in xrange(4, 7)]
+            )
+
+    def testRunningTwiceDoesNotDuplicateCharges(self):
+        self.assertEqual(len(self._run()), 5)
+        self.assertEqual(len(self._run()), 0)
+        self.assertEqual(models.Charge.objects.count(), 5)
+
+    def _bill(self, run=None):
+        tenants = models.Tenant.objects.filter(pk=self.tenant.pk)
+        return list(billing.bill_tenants(
+            datetime.date(2014, 1, 1), datetime.date(2014, 6, 1), tenants, processes=1, run=run
+            ))
+
+    def testResumedRunSkipsCheckpointedTenants(self):
+        shards = self._bill(run='first')
+        self.assertEqual([(s.tenant_id, s.charges, s.error) for s in shards], [(self.tenant.id, 5, None)])
+        self.assertEqual(models.BillingCheckpoint.objects.get().charges_created, 5)
+        self.assertEqual(self._bill(run='first'), [])
+
+    def testNewRunsBillLaterProvisions(self):
+        self._bill()
+        other = make_contract(
+            self.tenant, 'software', datetime.date(2014, 1, 1), datetime.date(2014, 12, 31)
+            )
+        asset = other.offer.item
+        UserProvisionHistory.objects.create(
+            user=self.user, service=self.service,
+            item_type=ContentType.objects.get_for_model(asset), object_id=asset.id,
+            start=datetime.datetime(2014, 5, 20), end=None
+            )
+        shards = self._bill()
+        self.assertEqual([s.charges for s in shards], [2])
+        self.assertEqual(models.Charge.objects.count(), 7)
+
+
+class ContractIndexTestCase(TestCase):
+    def setUp(self):
+        self.tenant = TenantFactory()
+        self.contract = make_contract(
+            self.tenant, 'software', datetime.date(2014, 1, 1), datetime.date(2014, 6, 30)
+            )
+        self.asset = self.contract.offer.item
+
+    def _lookup(self, start, end):
+        return models.Contract.objects.valid_offer_for_item(self.tenant, self.asset, start, end)
+
+    def testIndexedLookupMatchesDatabase(self):
+        periods = [month(2013, 12), month(2014, 1), month(2014, 6), month(2014, 7)]
+        expected = [self._lookup(start, end) for start, end in periods]
+        self.assertEqual(expected, [None, self.contract, self.contract, None])
+
+        with models.Contract.objects.indexed():
+            with self.assertNumQueries(0):
+                self.assertEqual([self._lookup(start, end) for start, end in periods], expected)
+
+    def testIndexFollowsSavedContracts(self):
+        start, end = month(2014, 9)
+        with models.Contract.objects.indexed():
+            self.assertEqual(self._lookup(start, end), None)
+            renewal = factories.ContractFactory(
+                tenant=self.tenant, offer=self.contract.offer, category='software',
+                start_date=datetime.date(2014, 7, 1), end_date=datetime.date(2014, 12, 31)
+                )
+            self.assertEqual(self._lookup(start, end), renewal)
+
+            renewal.delete()
+            self.assertEqual(self._lookup(start, end), None)
+
+    def testFilteredLookupsIgnoreTheIndex(self):
+        start, end = month(2014, 3)
+        item_type = ContentType.objects.get_for_model(self.asset)
+        with models.Contract.objects.indexed():
+            self.assertEqual(
+                models.Contract.objects.filter(category='devices').valid_contract(
+                    self.tenant.id, item_type.id, self.asset.id, start, end
+                    ),
+                None
+                )
+
+    def testMissesOfAFilteredIndexAreQueried(self):
+        start, end = month(2014, 3)
+        with models.Contract.objects.filter(category='devices').indexed():
+            self.assertEqual(self._lookup(start, end), self.contract)
@@ -18,7 +18,6 @@
 import calendar
 import datetime
 
-from django.db.models import Sum
 from dateutil.relativedelta import relativedelta
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -63,45 +62,30 @@ class CostView(APIView):
             yield dt, datetime.date(year=dt.year, month=dt.month, day=end_day)
         raise StopIteration
 
-    def _serialize(self, category, qs, start_date, end_date):
-        expenses = self._expenses_with_category(qs, category)
+    def _serialize(self, category, costs, periods):
         return [{
             'date': '%4d-%02d' % (start.year, start.month),
-            'cost': round(self._break_down_by_period(expenses, start, end), 2)
-            } for start, end in self._make_periods(start_date, end_date)]
+            'cost': round(self._cost(*costs.get((category, start), (0, 0))), 2)
+            } for start, end in periods]
 
-    def _expenses_with_category(self, qs, category):
-        return qs.filter(contract__category=category)
-
-    def _break_down_by_period(self, qs, start, end):
+    def _cost(self, total, users):
         raise NotImplementedError
 
-    def _charges_in_period(self, qs, start, end):
-        return qs.exclude(start_date__gt=end).exclude(end_date__lt=start)
-
-    def _total_charges(self, qs):
-        return qs.aggregate(total=Sum('amount')).get('total') or 0
-
-    def get_queryset(self, *args, **kw):
-        return models.Charge.objects.filter(user__tenant=self.request.user.tenant)
-
     def get(self, request, *args, **kw):
-        qs = self.get_queryset()
         start_date, end_date = self._get_interval()
+        periods = list(self._make_periods(start_date, end_date))
+        costs = models.MonthlyCostRollup.objects.costs(request.user.tenant, periods)
 
         return Response(
-            {c: self._serialize(c, qs, start_date, end_date) for c in models.EXPENSE_CATEGORIES}
+            {c: self._serialize(c, costs, periods) for c in models.EXPENSE_CATEGORIES}
             )
 
 
 class ChargesCostView(CostView):
-    def _break_down_by_period(self, qs, start, end):
-        return self._total_charges(self._charges_in_period(qs, start, end))
+    def _cost(self, total, users):
+        return total
 
 
 class UserCostView(CostView):
-    def _break_down_by_period(self, qs, start, end):
-        charges = self._charges_in_period(qs, start, end)
-        total_users = charges.values('user').distinct().count()
-        total_cost = self._total_charges(charges)
-        return 0 if not total_users else total_cost / total_users
+    def _cost(self, total, users):
+        return 0 if not users else total / users
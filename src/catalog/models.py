@@ -23,6 +23,8 @@ from model_utils.managers import InheritanceManager, QueryManager
 from model_utils.models import TimeStampedModel
 from model_utils.fields import StatusField
 
+from contrib.models import Subclassable
+
 
 CURRENCIES = (
     ('EUR', 'Euro'),
@@ -35,7 +37,7 @@ class CatalogEditionError(Exception):
     pass
 
 
-class Offer(TimeStampedModel):
+class Offer(Subclassable, TimeStampedModel):
     STATUS = Choices('inactive', 'available', 'retired', 'suspended')
 
     objects = InheritanceManager()
@@ -62,10 +64,6 @@ class Offer(TimeStampedModel):
     def monthly_cost(self):
         return 0
 
-    @property
-    def __subclassed__(self):
-        return Offer.objects.get_subclass(id=self.id)
-
     def activate(self):
         if self.status == self.STATUS.retired:
             raise CatalogEditionError('Can not activate a retired item')
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import Queue
+from collections import namedtuple
+
+from django.db import connection
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+
+Result = namedtuple('Result', ['item', 'value', 'error'])
+
+
+def fan_out(func, items, concurrency=DEFAULT_CONCURRENCY):
+    # Runs func over items on at most `concurrency` threads and returns one
+    # Result per item, in the order of items. Exceptions are not raised but
+    # reported on the Result, so one failing call does not stop the others.
+    items = list(items)
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for idx, item in enumerate(items):
+        pending.put((idx, item))
+
+    def run_pending():
+        while True:
+            try:
+                idx, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[idx] = Result(item, func(item), None)
+            except Exception, why:
+                log.warn('Failed to process %s: %s' % (item, why))
+                results[idx] = Result(item, None, why)
+
+    def worker():
+        try:
+            run_pending()
+        finally:
+            # Threads get their own database connection, which would
+            # otherwise stay open after the thread is gone.
+            connection.close()
+
+    if concurrency <= 1 or len(items) <= 1:
+        run_pending()
+        return results
+
+    workers = [threading.Thread(target=worker) for _ in xrange(min(concurrency, len(items)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
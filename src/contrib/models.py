@@ -14,11 +14,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import threading
+from contextlib import contextmanager
 
 from django.db import models
 from jsonfield import JSONField
 
 
+_unit_of_work = threading.local()
+
+
+@contextmanager
+def subclass_cache():
+    # Within this block, objects of the same row share one resolved subclass
+    # instance, so resolving it again does not go back to the database.
+    previous = getattr(_unit_of_work, 'subclasses', None)
+    if previous is None:
+        _unit_of_work.subclasses = {}
+    try:
+        yield
+    finally:
+        _unit_of_work.subclasses = previous
+
+
 class PropertyTable(models.Model):
     metadata = JSONField(null=True)
 
@@ -32,3 +50,64 @@ class PropertyTable(models.Model):
 
     class Meta:
         abstract = True
+
+
+class Subclassable(object):
+    # For models managed by model_utils' InheritanceManager. __subclassed__
+    # returns the instance of the most specific subclass for this row,
+    # resolved once per object (and once per subclass_cache() block).
+
+    @classmethod
+    def _subclass_root(cls):
+        model = cls._meta.concrete_model
+        while model._meta.parents:
+            model = list(model._meta.parents)[0]
+        return model
+
+    @classmethod
+    def _is_leaf(cls):
+        return not [
+            sub for sub in cls.__subclasses__()
+            if not sub._meta.abstract and not sub._meta.proxy
+            ]
+
+    def _remember_subclassed(self, instance):
+        self.__dict__['_subclassed'] = instance
+        instance.__dict__['_subclassed'] = instance
+        cache = getattr(_unit_of_work, 'subclasses', None)
+        if cache is not None:
+            cache[(self._subclass_root(), self.pk)] = instance
+        return instance
+
+    @staticmethod
+    def _cached_subclassed(obj):
+        instance = obj.__dict__.get('_subclassed')
+        if instance is None and obj._is_leaf():
+            instance = obj
+        cache = getattr(_unit_of_work, 'subclasses', None)
+        if instance is None and cache is not None:
+            instance = cache.get((obj._subclass_root(), obj.pk))
+        return instance
+
+    @property
+    def __subclassed__(self):
+        instance = self._cached_subclassed(self)
+        if instance is None:
+            instance = self._subclass_root().objects.get_subclass(pk=self.pk)
+        return self._remember_subclassed(instance)
+
+    @classmethod
+    def resolve_subclasses(cls, objects):
+        # Bulk version of __subclassed__: one query for all unresolved objects
+        objects = list(objects)
+        pending = set(obj.pk for obj in objects if cls._cached_subclassed(obj) is None)
+        resolved = {}
+        if pending:
+            resolved = dict(
+                (instance.pk, instance) for instance in
+                cls._subclass_root().objects.filter(pk__in=pending).select_subclasses()
+                )
+        return [
+            obj._remember_subclassed(resolved.get(obj.pk) or obj.__subclassed__)
+            for obj in objects
+            ]
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from concurrency import fan_out
+
+
+class FanOutTestCase(SimpleTestCase):
+    def testResultsFollowTheOrderOfItems(self):
+        def slower_first(item):
+            time.sleep(0.01 * (5 - item))
+            return item * 2
+
+        results = fan_out(slower_first, range(5), concurrency=5)
+        self.assertEqual([r.item for r in results], range(5))
+        self.assertEqual([r.value for r in results], [0, 2, 4, 6, 8])
+
+    def testErrorsAreReportedPerItem(self):
+        def invert(item):
+            return 1.0 / item
+
+        results = fan_out(invert, [1, 0, 2], concurrency=3)
+        self.assertEqual([r.value for r in results], [1.0, None, 0.5])
+        self.assertEqual([r.error is None for r in results], [True, False, True])
+        self.assertIsInstance(results[1].error, ZeroDivisionError)
+
+    def testConcurrencyIsBounded(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+        threads = set()
+
+        def track(item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+                threads.add(threading.current_thread())
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        results = fan_out(track, range(8), concurrency=2)
+        self.assertEqual(len(results), 8)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(len(threads), 2)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def testSingleItemsRunOnTheCallingThread(self):
+        results = fan_out(lambda item: threading.current_thread(), ['only'])
+        self.assertEqual(results[0].value, threading.current_thread())
@@ -72,6 +72,7 @@ USE_TZ = False
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 LOG_DIR = os.path.join(BASE_DIR, 'log')
 CERTIFICATES_DIR = os.path.join(BASE_DIR, 'etc', 'certificates')
+GOOGLE_DISCOVERY_DIR = os.path.join(BASE_DIR, 'etc', 'google')
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.7/howto/static-files/
@@ -108,6 +109,16 @@ PROVISIONABLE_SERVICES = [
     'provisioning.models.AirWatch'
     ]
 
+# seconds the list of available devices is served from cache before it is
+# refreshed in the background, and after which it is not served any more.
+AVAILABLE_DEVICES_TTL = 5 * 60
+AVAILABLE_DEVICES_MAX_STALE = 60 * 60
+# seconds each device provider gets to list its devices
+DEVICE_PROVIDER_TIMEOUT = 10
+# seconds a running provisioning job may go without saving its progress
+# before it is considered lost and queued again.
+PROVISIONING_JOB_TIMEOUT = 30 * 60
+
 from local_settings import *
 
 
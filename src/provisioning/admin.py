@@ -78,8 +78,22 @@ class LastSeenEvent(admin.ModelAdmin):
     search_fields = ('user__username', )
 
 
+@admin.register(models.LastSeenSummary)
+class LastSeenSummary(admin.ModelAdmin):
+    list_display = ('user', 'item', 'last_seen')
+    search_fields = ('user__username', )
+
+
 @admin.register(models.InventoryEntry)
 class InventoryEntry(admin.ModelAdmin):
     list_display = ('serial_number', 'user', 'status')
     search_fields = ('tenant_asset__asset__name',)
     list_filter = ('status', )
+
+
+@admin.register(models.ProvisioningJob)
+class ProvisioningJob(admin.ModelAdmin):
+    list_display = ('user', 'editor', 'status', 'created', 'modified')
+    search_fields = ('user__username', )
+    list_filter = ('status', )
+    readonly_fields = ('changes', 'progress', 'error')
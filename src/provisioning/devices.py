@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from contrib.matching import AhoCorasick
+from tenants.tasks import scheduler
+
+
+log = logging.getLogger(__name__)
+
+# Cached device lists are served as they are for AVAILABLE_DEVICES_TTL
+# seconds. After that they are still served, while a refresh runs in the
+# background, until they are AVAILABLE_DEVICES_MAX_STALE seconds old.
+AVAILABLE_DEVICES_TTL = getattr(settings, 'AVAILABLE_DEVICES_TTL', 5 * 60)
+AVAILABLE_DEVICES_MAX_STALE = getattr(settings, 'AVAILABLE_DEVICES_MAX_STALE', 60 * 60)
+# seconds each device provider (AirWatch, Google) gets to answer
+DEVICE_PROVIDER_TIMEOUT = getattr(settings, 'DEVICE_PROVIDER_TIMEOUT', 10)
+
+# Devices enrolled on AirWatch but not handed out yet are registered to
+# nobody or to the staging user.
+UNASSIGNED_USERNAMES = ('', 'staging')
+
+
+def device_summary(device):
+    return {
+        'model': device['Model'],
+        'username': device['UserName'],
+        'serial_number': device['SerialNumber']
+    }
+
+
+class DeviceInventory(object):
+    # All devices of an AirWatch tenant, indexed by user and by serial number
+    # in one pass over the (paged) device listing.
+
+    def __init__(self, devices=()):
+        self.devices = []
+        self.by_username = {}
+        self.by_serial = {}
+        for device in devices:
+            self.add(device)
+
+    def add(self, device):
+        self.devices.append(device)
+        username = (device.get('UserName') or '').lower()
+        self.by_username.setdefault(username, []).append(device)
+        serial_number = device.get('SerialNumber')
+        if serial_number:
+            self.by_serial[serial_number] = device
+
+    def for_user(self, username):
+        return self.by_username.get(username.lower(), [])
+
+    def find(self, serial_number):
+        return self.by_serial.get(serial_number)
+
+    def summaries(self):
+        return [device_summary(d) for d in self.devices]
+
+    def available(self):
+        return [
+            device_summary(d)
+            for username in UNASSIGNED_USERNAMES
+            for d in self.by_username.get(username, [])
+        ]
+
+    def __len__(self):
+        return len(self.devices)
+
+
+def fetch_from_providers(providers, timeout=None):
+    # Calls every provider on its own thread and waits at most `timeout`
+    # seconds for each of them. Devices of the providers that answered are
+    # returned; the ones that failed or timed out are reported as warnings.
+    timeout = DEVICE_PROVIDER_TIMEOUT if timeout is None else timeout
+    results = {}
+    lock = threading.Lock()
+
+    def call(name, fetch):
+        try:
+            value = (fetch(), None)
+        except Exception, why:
+            log.warn('Could not fetch devices from %s: %s' % (name, why))
+            value = (None, '%s' % why)
+        finally:
+            connection.close()
+        with lock:
+            results[name] = value
+
+    threads = []
+    for name, fetch in providers:
+        thread = threading.Thread(target=call, args=(name, fetch))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+    devices, warnings = [], []
+    with lock:
+        for name, _ in providers:
+            found, error = results.get(name, (None, 'timed out after %ss' % timeout))
+            if error is not None:
+                warnings.append({'provider': name, 'error': error})
+            else:
+                devices.extend(found)
+    return {'devices': devices, 'warnings': warnings}
+
+
+class AvailableDeviceCache(object):
+    KEY = 'provisioning:available-devices:v2:%s'
+    REFRESH_KEY = 'provisioning:available-devices:v2:%s:refreshing'
+
+    def __init__(self, tenant, fetch=None, ttl=None, max_stale=None):
+        self.tenant = tenant
+        self.fetch = fetch
+        self.ttl = AVAILABLE_DEVICES_TTL if ttl is None else ttl
+        self.max_stale = AVAILABLE_DEVICES_MAX_STALE if max_stale is None else max_stale
+
+    @property
+    def key(self):
+        return self.KEY % self.tenant.pk
+
+    @property
+    def refresh_key(self):
+        return self.REFRESH_KEY % self.tenant.pk
+
+    def get(self):
+        entry = cache.get(self.key)
+        if entry is None:
+            return self.refresh()
+        if time.time() - entry['fetched_at'] > self.ttl:
+            self.refresh_in_background()
+        return entry['result']
+
+    def refresh(self):
+        # Partial results (some provider failed) are not cached, so that the
+        # next request tries again instead of serving them until they expire.
+        result = self.fetch(self.tenant)
+        if not result['warnings']:
+            cache.set(self.key, {'result': result, 'fetched_at': time.time()}, self.max_stale)
+        return result
+
+    def refresh_in_background(self):
+        # The refresh key keeps concurrent requests from starting one refresh
+        # each; it expires on its own should the refresh die.
+        if not cache.add(self.refresh_key, True, self.ttl):
+            return
+
+        def refresh():
+            try:
+                self.refresh()
+            except Exception, why:
+                log.warn('Could not refresh available devices of %s: %s' % (self.tenant, why))
+            finally:
+                cache.delete(self.refresh_key)
+        scheduler.schedule(refresh)
+
+    def invalidate(self):
+        cache.delete(self.key)
+
+
+class DeviceModelMatcher(object):
+    # Tells which of the tenant's Device assets a remote device is, by
+    # looking for the asset name in the device model. When several names
+    # match, the last tenant asset wins, as it did with the plain loop.
+    KEY = 'provisioning:device-model-matcher:%s'
+
+    def __init__(self, tenant_assets):
+        # tenant_assets: (tenant asset id, asset id, asset name) tuples
+        self.tenant_assets = list(tenant_assets)
+        self.automaton = AhoCorasick(
+            (name.lower(), idx) for idx, (_, _, name) in enumerate(self.tenant_assets)
+        )
+
+    @classmethod
+    def for_tenant(cls, tenant, load):
+        matcher = cache.get(cls.KEY % tenant.pk)
+        if matcher is None:
+            matcher = cls(load(tenant))
+            cache.set(cls.KEY % tenant.pk, matcher, None)
+        return matcher
+
+    @classmethod
+    def invalidate(cls, tenant_ids):
+        cache.delete_many([cls.KEY % tenant_id for tenant_id in tenant_ids])
+
+    def match(self, model):
+        found = self.automaton.search(model.lower())
+        return self.tenant_assets[max(found)] if found else None
+
+    def annotate(self, devices):
+        for device in devices:
+            match = self.match(device['model'])
+            if match is not None:
+                device['tenant_asset_id'], device['device_id'], _ = match
+        return devices
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from collections import namedtuple
+
+from django.db import transaction
+
+from contrib.concurrency import fan_out
+from contrib.models import subclass_cache
+from tenants.models import TenantService
+
+import models
+
+
+log = logging.getLogger(__name__)
+
+PROVISION = 'provision'
+DEPROVISION = 'deprovision'
+REGISTER = 'register'
+
+# Registration jobs wait for the new user to show up in Active Directory,
+# with a delay doubling from REGISTRATION_FIRST_DELAY up to
+# REGISTRATION_MAX_DELAY seconds between attempts.
+REGISTRATION_ATTEMPTS = 8
+REGISTRATION_FIRST_DELAY = 0.5
+REGISTRATION_MAX_DELAY = 60.0
+
+Operation = namedtuple('Operation', ['action', 'service', 'item'])
+
+
+class ProvisioningExecutor(object):
+    # Runs the remote side of a set of (de)provisioning operations in
+    # parallel: services run side by side, and each service gets at most
+    # its PROVISIONING_CONCURRENCY calls at a time. The local records of the
+    # operations that succeeded are written afterwards in one transaction.
+
+    def __init__(self, user, editor=None, concurrency=None, on_progress=None):
+        self.user = user
+        self.editor = editor
+        self.concurrency = concurrency
+        self.on_progress = on_progress
+        self.progress = []
+        self.errors = []
+        self._entries = {}
+
+    def _track(self, action, service, item, state, error=None):
+        key = (action, service.pk, item and item.pk)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {
+                'action': action,
+                'service': service.service,
+                'item': item and '%s' % item
+                }
+            self.progress.append(entry)
+        entry.update(state=state, error=error and '%s' % error)
+        if error is not None:
+            self.errors.append(entry)
+
+    def _notify(self):
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+
+    def _service_concurrency(self, service):
+        if self.concurrency is not None:
+            return self.concurrency
+        return service.PROVISIONING_CONCURRENCY
+
+    def _services_concurrency(self, services):
+        return min(len(services), self.concurrency or len(services))
+
+    def _run_remote(self, operation):
+        if operation.action == PROVISION:
+            operation.item.provision_remote(operation.service, self.user)
+        else:
+            operation.item.deprovision_remote(operation.service, self.user)
+
+    def _run_service(self, operations):
+        return fan_out(
+            self._run_remote, operations, self._service_concurrency(operations[0].service)
+            )
+
+    def _report(self, operation, error):
+        log.warn('Failed to %s %s on %s for %s: %s' % (
+            operation.action, operation.item, operation.service, self.user, error
+            ))
+        self._track(operation.action, operation.service, operation.item, 'failed', error)
+
+    def run(self, operations):
+        by_service = {}
+        for operation in operations:
+            by_service.setdefault(operation.service.pk, []).append(operation)
+
+        for operation in operations:
+            operation.item.prepare_remote(operation.service)
+
+        succeeded = []
+        service_results = fan_out(
+            self._run_service, by_service.values(), self._services_concurrency(by_service)
+            )
+        for service_result in service_results:
+            if service_result.error is not None:
+                for operation in service_result.item:
+                    self._report(operation, service_result.error)
+                continue
+            for result in service_result.value:
+                if result.error is not None:
+                    self._report(result.item, result.error)
+                else:
+                    succeeded.append(result.item)
+
+        with transaction.atomic():
+            for operation in succeeded:
+                if operation.action == PROVISION:
+                    operation.item.record_provision(operation.service, self.user, editor=self.editor)
+                else:
+                    operation.item.record_deprovision(operation.service, self.user, editor=self.editor)
+                self._track(operation.action, operation.service, operation.item, 'done')
+        self._notify()
+        return succeeded
+
+    def _change_service_remote(self, action, service, assets):
+        if action == 'activate':
+            service.activate_remote(self.user)
+        else:
+            service.deactivate_remote(self.user, assets)
+
+    def _change_services(self, action, services):
+        # Same split as run(): the remote calls of all services run side by
+        # side, everything they need from the database is read beforehand
+        # and the local changes are made afterwards in one transaction.
+        assets = {}
+        if action == 'deactivate':
+            for service in services:
+                assets[service.pk] = service.provisioned_assets(self.user)
+                for asset in assets[service.pk]:
+                    asset.prepare_remote(service)
+
+        results = fan_out(
+            lambda service: self._change_service_remote(action, service, assets.get(service.pk)),
+            services, self._services_concurrency(services)
+            )
+
+        changed = []
+        with transaction.atomic():
+            for result in results:
+                service = result.item
+                if result.error is not None:
+                    self._track(action, service, None, 'failed', result.error)
+                    continue
+                if action == 'activate':
+                    service.record_activation(self.user, editor=self.editor)
+                else:
+                    service.record_deactivation(self.user, assets[service.pk], editor=self.editor)
+                self._track(action, service, None, 'done')
+                changed.append(service)
+        self._notify()
+        return changed
+
+    def activate(self, services):
+        return self._change_services('activate', services)
+
+    def deactivate(self, services):
+        return self._change_services('deactivate', services)
+
+    def _plan_service(self, service, selected_services, item_class, selected):
+        current = self.user.get_provisioned_items(item_class=item_class, service=service)
+
+        to_add = [
+            item for item in models.Asset.resolve_subclasses(
+                [it for it in selected if it not in current])
+            if item.can_be_managed_by(service) and service in selected_services
+        ]
+
+        to_remove = current if service not in selected_services else [
+            item for item in models.Asset.resolve_subclasses(
+                [it for it in current if it not in selected])
+            if item.can_be_managed_by(service)
+        ]
+
+        operations = []
+        for item in to_add:
+            log.debug('Adding %s to %s' % (item, service))
+            operations.append(Operation(PROVISION, service, item))
+
+        for item in to_remove:
+            log.debug('Removing %s from %s' % (item, service))
+            operations.append(Operation(DEPROVISION, service, item))
+        return operations
+
+    def plan(self, provision_data):
+        selected_services = TenantService.resolve_subclasses(provision_data.get('platforms', []))
+        operations = []
+        for service in self.user.tenant.tenantservice_set.select_subclasses():
+            for field_name, item_class in models.ProvisioningJob.ASSET_CLASSES.items():
+                if field_name in provision_data:
+                    operations.extend(self._plan_service(
+                        service, selected_services, item_class, provision_data[field_name]
+                    ))
+        return operations
+
+    def apply(self, provision_data):
+        # Brings the user's services and assets in line with provision_data,
+        # as submitted to UserProvisionSerializer.
+        with subclass_cache():
+            operations = self.plan(provision_data)
+            current_services = self.user.services.select_subclasses()
+            new_services = TenantService.resolve_subclasses(provision_data.get('platforms', []))
+            services_to_add = [s for s in new_services if s not in current_services]
+            services_to_remove = [s for s in current_services if s not in new_services]
+
+            for operation in operations:
+                self._track(operation.action, operation.service, operation.item, 'pending')
+            for service in services_to_add:
+                self._track('activate', service, None, 'pending')
+            for service in services_to_remove:
+                self._track('deactivate', service, None, 'pending')
+            self._notify()
+
+            self.run(operations)
+            self.activate(services_to_add)
+            self.deactivate(services_to_remove)
+        return self.errors
+
+
+def _is_visible(user):
+    try:
+        return user.get_remote() is not None
+    except Exception, why:
+        log.debug('Could not look up %s in active directory: %s' % (user, why))
+        return False
+
+
+def run_registration(job):
+    # Services that depend on AD can only see the user once it got there.
+    # Until then the job is queued again with a growing delay; after the last
+    # attempt, registration is tried anyway.
+    if not _is_visible(job.user) and job.attempts + 1 < REGISTRATION_ATTEMPTS:
+        job.retry(min(REGISTRATION_FIRST_DELAY * 2 ** job.attempts, REGISTRATION_MAX_DELAY))
+        return job
+
+    executor = ProvisioningExecutor(job.user)
+    for service in job.services:
+        try:
+            service.register(job.user)
+        except Exception, why:
+            log.warn('Failed when registering user %s on %s: %s' % (job.user, service, why))
+            executor._track(REGISTER, service, None, 'failed', why)
+        else:
+            executor._track(REGISTER, service, None, 'done')
+    job.progress = executor.progress
+    job.status = job.STATUS.completed
+    job.save()
+    return job
+
+
+def run_job(job):
+    if job.action == job.ACTION.register:
+        return run_registration(job)
+
+    def save_progress(progress):
+        job.progress = progress
+        job.save()
+
+    executor = ProvisioningExecutor(job.user, editor=job.editor, on_progress=save_progress)
+    try:
+        executor.apply(job.provision_data)
+        if executor.progress:
+            job.user.save(editor=job.editor)
+        job.status = job.STATUS.completed
+    except Exception, why:
+        log.exception('Provisioning job %s failed' % job.pk)
+        job.status = job.STATUS.failed
+        job.error = '%s' % why
+    job.progress = executor.progress
+    job.save()
+    return job
@@ -15,13 +15,57 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import os
+import threading
+
 import httplib2
 from apiclient import errors
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document
 from oauth2client.client import SignedJwtAssertionCredentials
-import os
 from django.conf import settings
-# import pprint
+
+
+log = logging.getLogger(__name__)
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+
+# Discovery documents are read from DISCOVERY_DIR, where the ones in use
+# are shipped (etc/google), so clients are built without a round trip to
+# Google. A missing document is fetched once and stored there if possible.
+DISCOVERY_DIR = getattr(
+    settings, 'GOOGLE_DISCOVERY_DIR', os.path.join(settings.BASE_DIR, 'etc', 'google')
+)
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def discovery_document(api, version, directory=None):
+    path = os.path.join(directory or DISCOVERY_DIR, '%s.%s.json' % (api, version))
+    with _documents_lock:
+        document = _documents.get(path)
+        if document is not None:
+            return document
+
+        if os.path.exists(path):
+            with open(path) as f:
+                document = f.read()
+        else:
+            url = DISCOVERY_URL % (api, version)
+            response, document = httplib2.Http().request(url)
+            if response.status >= 400:
+                raise errors.HttpError(response, document, uri=url)
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + '.tmp', 'w') as f:
+                    f.write(document)
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError), why:
+                log.warn('Could not store discovery document %s: %s' % (path, why))
+        _documents[path] = document
+        return document
 
 
 class Client(object):
@@ -29,9 +73,9 @@ class Client(object):
     OAUTH_SCOPE = ['https://www.googleapis.com/auth/admin.directory.user',
                    'https://www.googleapis.com/auth/admin.directory.device.chromeos']
 
-    def __init__(self, tenant):
-        google_tenant_asset = tenant.tenantasset_set.get(
-            asset__name='Google Account')
+    def __init__(self, tenant, google_tenant_asset=None):
+        if google_tenant_asset is None:
+            google_tenant_asset = tenant.tenantasset_set.get(asset__name='Google Account')
         certificate_file_path = os.path.join(
             settings.CERTIFICATES_DIR, google_tenant_asset.get('CERTIFICATE_FILE_NAME')
         )
@@ -46,40 +90,68 @@ class Client(object):
         )
 
         # Create an httplib2.Http object and authorize it with our
-        # credentials
+        # credentials. The access token is kept on the credentials and only
+        # refreshed once it expired.
         http = httplib2.Http()
         http = credentials.authorize(http)
-        self.directory_service = build('admin', 'directory_v1', http=http)
+        self.directory_service = build_from_document(
+            discovery_document('admin', 'directory_v1'), http=http
+        )
         self.administrator_username = google_tenant_asset.get('ADMINISTRATOR')
+        # httplib2.Http is not thread safe
+        self._lock = threading.Lock()
 
-    def get_available_devices(self):
-        return [d for d in self.get_devices() if d['username'] == self.administrator_username]
-
-    def get_devices(self):
-        all_devices = []
+    def _list_all(self, collection, key, **params):
+        # An HttpError is raised rather than returning the pages read so
+        # far, so that callers do not take a partial list for a full one.
+        items = []
         page_token = None
-        params = {'customerId': 'my_customer'}
 
         while True:
-            try:
-                if page_token:
-                    params['pageToken'] = page_token
-                current_page = self.directory_service.chromeosdevices().list(
-                    **params).execute()
-                all_devices.extend(current_page['chromeosdevices'])
-                page_token = current_page.get('nextPageToken')
-                if not page_token:
-                    break
-            except errors.HttpError as error:
-                self.stderr.write('An error occurred: %s' % error)
+            if page_token:
+                params['pageToken'] = page_token
+            with self._lock:
+                current_page = collection().list(**params).execute()
+            items.extend(current_page.get(key, []))
+            page_token = current_page.get('nextPageToken')
+            if not page_token:
                 break
+        return items
+
+    def get_users(self):
+        return self._list_all(self.directory_service.users, 'users', customer='my_customer')
+
+    def get_chromeos_devices(self):
+        return self._list_all(
+            self.directory_service.chromeosdevices, 'chromeosdevices', customerId='my_customer'
+        )
+
+    def get_available_devices(self):
+        return [d for d in self.get_devices() if d['username'] == self.administrator_username]
 
-        # pp = pprint.PrettyPrinter(indent=4)
-        # pp.pprint(all_devices)
+    def get_devices(self):
         return [
             {
                 'model': d.get('model', d.get('notes', 'UNKNOWN')),
                 'username': d['annotatedUser'],
                 'serial_number': d['serialNumber']
-            } for d in all_devices
+            } for d in self.get_chromeos_devices()
         ]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(tenant):
+    # One client per tenant, replaced when the tenant's Google settings change
+    google_tenant_asset = tenant.tenantasset_set.get(asset__name='Google Account')
+    key = tuple(google_tenant_asset.get(prop) for prop in [
+        'CLIENT_EMAIL', 'ADMINISTRATOR', 'CERTIFICATE_FILE_NAME'
+    ])
+    with _clients_lock:
+        stored_key, client = _clients.get(tenant.pk, (None, None))
+        if client is None or stored_key != key:
+            client = Client(tenant, google_tenant_asset=google_tenant_asset)
+            _clients[tenant.pk] = (key, client)
+        return client
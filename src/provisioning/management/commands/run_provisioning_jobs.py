@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from provisioning.executor import run_job
+from provisioning.models import ProvisioningJob
+
+
+class Command(BaseCommand):
+    help = 'Process queued provisioning jobs'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-i', '--interval', dest='interval', type='float', default=2.0,
+            help='seconds to wait for new jobs when the queue is empty'
+            ),
+        make_option(
+            '--once', dest='once', action='store_true', default=False,
+            help='exit once the queue is empty'
+            ),
+    )
+
+    def handle(self, *args, **opts):
+        while True:
+            job = ProvisioningJob.objects.claim()
+            if job is None:
+                if opts['once']:
+                    return
+                time.sleep(opts['interval'])
+                continue
+
+            run_job(job)
+            self.stdout.write('%s' % job)
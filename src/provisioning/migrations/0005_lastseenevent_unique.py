@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def remove_duplicate_events(apps, schema_editor):
+    LastSeenEvent = apps.get_model('provisioning', 'LastSeenEvent')
+    duplicates = LastSeenEvent.objects.values(
+        'user', 'item_type', 'object_id', 'last_seen'
+    ).annotate(first_id=models.Min('id'), total=models.Count('id')).filter(total__gt=1)
+    for entry in duplicates:
+        LastSeenEvent.objects.filter(
+            user=entry['user'],
+            item_type=entry['item_type'],
+            object_id=entry['object_id'],
+            last_seen=entry['last_seen']
+        ).exclude(id=entry['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('provisioning', '0004_auto_20141203_1250'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_events),
+        migrations.AlterUniqueTogether(
+            name='lastseenevent',
+            unique_together=set([('user', 'item_type', 'object_id', 'last_seen')]),
+        ),
+    ]
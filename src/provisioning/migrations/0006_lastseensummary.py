@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def populate_summaries(apps, schema_editor):
+    LastSeenEvent = apps.get_model('provisioning', 'LastSeenEvent')
+    LastSeenSummary = apps.get_model('provisioning', 'LastSeenSummary')
+    latest = LastSeenEvent.objects.values(
+        'user', 'item_type', 'object_id'
+    ).annotate(latest=models.Max('last_seen'))
+    LastSeenSummary.objects.bulk_create([
+        LastSeenSummary(
+            user_id=entry['user'],
+            item_type_id=entry['item_type'],
+            object_id=entry['object_id'],
+            last_seen=entry['latest']
+        ) for entry in latest
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('tenants', '0001_initial'),
+        ('provisioning', '0005_lastseenevent_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LastSeenSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('last_seen', models.DateTimeField(db_index=True)),
+                ('item_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('user', models.ForeignKey(to='tenants.User')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lastseensummary',
+            unique_together=set([('user', 'item_type', 'object_id')]),
+        ),
+        migrations.RunPython(populate_summaries),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# PLATFORM_TYPE and service_slug() of each service model at the time of
+# this migration.
+SERVICE_COLUMNS = {
+    'Okta': ('web', 'okta'),
+    'AirWatch': ('mobile', 'airwatch'),
+    'MobileIron': ('mobile', 'mobile-iron'),
+}
+
+
+def fill_service_columns(apps, schema_editor):
+    TenantService = apps.get_model('tenants', 'TenantService')
+    for model_name, (platform_type, slug) in SERVICE_COLUMNS.items():
+        service_model = apps.get_model('provisioning', model_name)
+        TenantService.objects.filter(
+            id__in=service_model.objects.values_list('tenantservice_ptr', flat=True)
+        ).update(platform_type=platform_type, slug=slug)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0002_tenantservice_platform_type'),
+        ('provisioning', '0006_lastseensummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_service_columns),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import django.utils.timezone
+import jsonfield.fields
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tenants', '0002_tenantservice_platform_type'),
+        ('provisioning', '0007_tenantservice_platform_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisioningJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('status', model_utils.fields.StatusField(default=b'queued', max_length=100, verbose_name='status', no_check_for_status=True, choices=[(b'queued', b'queued'), (b'running', b'running'), (b'completed', b'completed'), (b'failed', b'failed')])),
+                ('status_changed', model_utils.fields.MonitorField(default=django.utils.timezone.now, verbose_name='status changed', monitor='status')),
+                ('changes', jsonfield.fields.JSONField()),
+                ('progress', jsonfield.fields.JSONField(default=list)),
+                ('error', models.TextField(null=True, blank=True)),
+                ('editor', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL, null=True)),
+                ('user', models.ForeignKey(related_name='provisioning_jobs', to='tenants.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('provisioning', '0008_provisioningjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provisioningjob',
+            name='action',
+            field=models.CharField(default=b'provision', max_length=20, choices=[(b'provision', b'provision'), (b'register', b'register')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='provisioningjob',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='provisioningjob',
+            name='run_after',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -24,9 +24,12 @@ from autoslug import AutoSlugField
 from django.conf import settings
 from django.core.mail import send_mail
 from django.db import models
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.template.loader import render_to_string
+from jsonfield import JSONField
 from litedesk.lib import airwatch
 from model_utils import Choices
 from model_utils.managers import InheritanceManager
@@ -35,14 +38,19 @@ from qrcode.image.pure import PymagingImage
 import qrcode
 
 from audit.models import Trackable
-from contrib.models import PropertyTable
+from contrib.models import PropertyTable, Subclassable
 from tenants.models import Tenant, TenantService, User
 from signals import item_provisioned, item_deprovisioned
+from devices import AvailableDeviceCache, DeviceInventory, DeviceModelMatcher
 import okta
 
 
 log = logging.getLogger(__name__)
 
+# seconds a running provisioning job may go without saving its progress
+# before it is handed to another worker.
+PROVISIONING_JOB_TIMEOUT = getattr(settings, 'PROVISIONING_JOB_TIMEOUT', 30 * 60)
+
 
 class Provisionable(object):
     def activate(self, user, **kw):
@@ -54,8 +62,32 @@ class Provisionable(object):
     def provision(self, service, user, *args, **kw):
         raise NotImplementedError
 
+    def schedule_registration(self, user):
+        return ProvisioningJob.objects.enqueue_registration(user, self)
+
+
+class UserProvisionableQuerySet(models.QuerySet):
+    def provisioned_assets(self, users, item_classes):
+        item_types = dict(
+            (ContentType.objects.get_for_model(klass).id, klass) for klass in item_classes
+        )
+        provisioned = list(self.filter(
+            user__in=users, item_type__in=item_types.keys()
+        ).values_list('user_id', 'item_type_id', 'object_id').distinct())
+
+        assets = Asset.objects.in_bulk(set(object_id for _, _, object_id in provisioned))
+        result = {}
+        for user_id, item_type_id, object_id in provisioned:
+            if object_id not in assets:
+                continue
+            user_assets = result.setdefault(user_id, dict((k, []) for k in item_classes))
+            user_assets[item_types[item_type_id]].append(assets[object_id])
+        return result
+
 
 class UserProvisionable(TimeStampedModel):
+    objects = models.Manager.from_queryset(UserProvisionableQuerySet)()
+
     user = models.ForeignKey(User)
     service = models.ForeignKey(TenantService)
     item_type = models.ForeignKey(ContentType)
@@ -112,7 +144,7 @@ class UserProvisionHistory(Trackable, TimeFramedModel):
             entry.save(editor=kw.get('editor'))
 
 
-class Asset(TimeStampedModel, Provisionable):
+class Asset(Subclassable, TimeStampedModel, Provisionable):
     objects = InheritanceManager()
     name = models.CharField(max_length=1000)
     slug = AutoSlugField(populate_from='name', unique=False, default='')
@@ -121,15 +153,32 @@ class Asset(TimeStampedModel, Provisionable):
     mobile = models.BooleanField(default=False)
     desktop = models.BooleanField(default=False)
 
-    @property
-    def __subclassed__(self):
-        return Asset.objects.get_subclass(id=self.id)
-
     @property
     def supported_platforms(self):
         return [p for p in ['web', 'mobile', 'desktop'] if getattr(self, p)]
 
     def provision(self, service, user, editor=None):
+        self.provision_remote(service, user)
+        self.record_provision(service, user, editor=editor)
+
+    def deprovision(self, service, user, editor=None):
+        self.deprovision_remote(service, user)
+        self.record_deprovision(service, user, editor=editor)
+
+    # The remote half of (de)provisioning talks to the service and may be run
+    # concurrently; the record half only touches the local database.
+    # prepare_remote does the database work the remote half needs, on the
+    # calling thread before the remote calls fan out.
+    def prepare_remote(self, service):
+        pass
+
+    def provision_remote(self, service, user):
+        pass
+
+    def deprovision_remote(self, service, user):
+        pass
+
+    def record_provision(self, service, user, editor=None):
         if self.can_be_managed_by(service):
             UserProvisionable.objects.create(
                 service=service,
@@ -145,7 +194,7 @@ class Asset(TimeStampedModel, Provisionable):
                 user=user
             )
 
-    def deprovision(self, service, user, editor=None):
+    def record_deprovision(self, service, user, editor=None):
         UserProvisionable.objects.filter(
             service=service,
             user=user,
@@ -170,13 +219,14 @@ class Asset(TimeStampedModel, Provisionable):
 class Software(Asset):
     EXPENSE_CATEGORY = 'software'
 
-    def provision(self, service, user, editor=None):
+    def prepare_remote(self, service):
+        service.asset_metadata(self)
+
+    def provision_remote(self, service, user):
         service.assign(self, user)
-        super(Software, self).provision(service, user, editor=editor)
 
-    def deprovision(self, service, user, editor=None):
+    def deprovision_remote(self, service, user):
         service.unassign(self, user)
-        super(Software, self).deprovision(service, user, editor=editor)
 
 
 class Device(Asset):
@@ -190,6 +240,15 @@ class Device(Asset):
             self.__class__ = ChromeDevice
         return self
 
+    @staticmethod
+    def on_change(*args, **kw):
+        # Renamed devices match other models. Devices are also edited as
+        # plain Asset rows, so those saves are checked for a device as well.
+        asset = kw.get('instance')
+        DeviceModelMatcher.invalidate(TenantAsset.objects.filter(
+            asset=asset, asset__device__isnull=False
+        ).values_list('tenant_id', flat=True))
+
     def _get_email_template_parameters(self, service, user):
         device = self.__subclassed__
         if isinstance(device, ChromeDevice):
@@ -216,9 +275,7 @@ class Device(Asset):
             format, template_name, extension
         )
 
-    def provision(self, service, user, editor=None):
-        super(Device, self).provision(service, user, editor=editor)
-
+    def provision_remote(self, service, user):
         html_template = self._get_email_template(service, format='html')
         text_template = self._get_email_template(service, format='text')
 
@@ -258,6 +315,10 @@ class TenantAsset(PropertyTable):
     tenant = models.ForeignKey(Tenant)
     asset = models.ForeignKey(Asset)
 
+    @staticmethod
+    def on_change(*args, **kw):
+        DeviceModelMatcher.invalidate([kw.get('instance').tenant_id])
+
     class Meta:
         unique_together = ('tenant', 'asset')
 
@@ -281,6 +342,12 @@ class InventoryEntry(Trackable, StatusModel):
     def __unicode__(self):
         return '%s (%s)' % (self.user.username, self.serial_number)
 
+    @staticmethod
+    def on_change(*args, **kw):
+        # A device handed out or returned changes what is available
+        entry = kw.get('instance')
+        AvailableDeviceCache(entry.tenant_asset.tenant).invalidate()
+
 
 class Okta(TenantService, Provisionable):
     PLATFORM_TYPE = TenantService.PLATFORM_TYPE_CHOICES.web
@@ -299,7 +366,22 @@ class Okta(TenantService, Provisionable):
         return '%s/help/login' % self.portal_url
 
     def get_client(self):
-        return okta.Client(self.domain, self.api_token)
+        return okta.get_client(self.domain, self.api_token)
+
+    def _discard_client(self):
+        if self.pk is None:
+            return
+        stored = Okta.objects.filter(pk=self.pk).values_list('domain', 'api_token').first()
+        if stored is not None and stored != (self.domain, self.api_token):
+            okta.discard_client(*stored)
+
+    def save(self, *args, **kw):
+        self._discard_client()
+        super(Okta, self).save(*args, **kw)
+
+    def delete(self, *args, **kw):
+        okta.discard_client(self.domain, self.api_token)
+        super(Okta, self).delete(*args, **kw)
 
     def get_service_user(self, user):
         client = self.get_client()
@@ -317,7 +399,7 @@ class Okta(TenantService, Provisionable):
             pass
         return self.get_service_user(user)
 
-    def activate(self, user, editor=None):
+    def activate_remote(self, user):
         client = self.get_client()
         try:
             service_user = self.get_service_user(user)
@@ -336,7 +418,10 @@ class Okta(TenantService, Provisionable):
             if status_before == 'STAGED':
                 activation_url = activation_response.get('activationUrl')
 
-        password = user.get_remote().set_one_time_password()
+        active_directory = user.tenant.active_directory
+        with active_directory.session() as session:
+            remote_user = active_directory.find_user(user.username, session=session)
+            password = remote_user.set_one_time_password()
         template_parameters = {
             'user': user,
             'service': self,
@@ -361,24 +446,20 @@ class Okta(TenantService, Provisionable):
             [user.email],
             html_message=html_msg
         )
-        super(Okta, self).activate(user, editor)
 
     def assign(self, asset, user):
         log.debug('Assigning %s to %s on Okta' % (asset, user))
-        metadata, _ = self.tenantserviceasset_set.get_or_create(asset=asset)
+        metadata = self.asset_metadata(asset)
         client = self.get_client()
         service_user = self.get_service_user(user)
         service_application = client.get(okta.Application,
                                          metadata.get('application_id'))
-        try:
-            service_application.assign(service_user,
-                                       profile=metadata.get('profile'))
-        except Exception, why:
-            log.warn('Error when assigning %s to %s: %s' % (asset, user, why))
+        service_application.assign(service_user,
+                                   profile=metadata.get('profile'))
 
     def unassign(self, asset, user):
         log.debug('Removing %s from %s on Okta' % (asset, user))
-        metadata, _ = self.tenantserviceasset_set.get_or_create(asset=asset)
+        metadata = self.asset_metadata(asset)
         client = self.get_client()
         service_user = self.get_service_user(user)
         service_application = client.get(okta.Application,
@@ -387,8 +468,6 @@ class Okta(TenantService, Provisionable):
             service_application.unassign(service_user)
         except okta.UserApplicationNotFound, e:
             log.info('Failed to unassign %s from %s: %s' % (asset, user, e))
-        except Exception, why:
-            log.warn('Error when unassigning %s to %s: %s' % (asset, user, why))
 
     @classmethod
     def get_serializer_data(cls, **data):
@@ -408,6 +487,7 @@ class AirWatch(TenantService, Provisionable):
     QRCODE_TEMPLATE = 'https://awagent.com?serverurl={0}&gid={1}'
 
     DEACTIVATION_EXCEPTION = airwatch.user.UserNotActiveError
+    DEVICE_PAGE_SIZE = 500
 
     username = models.CharField(max_length=80)
     password = models.CharField(max_length=1000)
@@ -464,7 +544,7 @@ class AirWatch(TenantService, Provisionable):
         image_url = self.QRCODE_ROOT_URL + server_domain + '/' + image_file_name
         return image_url
 
-    def activate(self, user, editor=None):
+    def activate_remote(self, user):
         service_user = self.get_service_user(user)
         if service_user is None:
             service_user = self.register(user)
@@ -495,15 +575,13 @@ class AirWatch(TenantService, Provisionable):
             )
         except airwatch.user.UserAlreadyActivatedError:
             pass
-        else:
-            super(AirWatch, self).activate(user, editor)
 
-    def deactivate(self, user, editor=None):
-        super(AirWatch, self).deactivate(user, editor)
+    def deactivate_remote(self, user, assets):
+        super(AirWatch, self).deactivate_remote(user, assets)
         self.get_service_user(user).delete()
 
     def __group_and_aw_user(self, software, user):
-        metadata, _ = self.tenantserviceasset_set.get_or_create(asset=software)
+        metadata = self.asset_metadata(software)
         group = self.get_usergroup(metadata.get('group_name'))
         service_user = self.get_service_user(user)
         return group, service_user
@@ -530,21 +608,36 @@ class AirWatch(TenantService, Provisionable):
         except airwatch.user.UserNotEnrolledError:
             pass
 
+    def iter_devices(self, page_size=None):
+        # mdm/devices/search is paged; without paging parameters AirWatch
+        # only returns its default first page.
+        client = self.get_client()
+        page_size = page_size or self.DEVICE_PAGE_SIZE
+        page = 0
+        while True:
+            response = client.call_api(
+                'GET', 'mdm/devices/search', params={'page': page, 'pagesize': page_size})
+            response.raise_for_status()
+            if response.status_code != 200:
+                # 204 once there are no devices (left)
+                return
+            data = response.json()
+            devices = data.get('Devices') or []
+            for device in devices:
+                yield device
+            page += 1
+            total = data.get('Total')
+            if len(devices) < page_size or (total is not None and page * page_size >= total):
+                return
+
+    def get_device_inventory(self, page_size=None):
+        return DeviceInventory(self.iter_devices(page_size=page_size))
+
     def get_all_devices(self):
-        endpoint = 'mdm/devices/search'
-        response = self.get_client().call_api(
-            'GET', endpoint)
-        response.raise_for_status()
-        if response.status_code == 200:
-            devices = [{'model': d['Model'], 'username': d['UserName'],
-                        'serial_number': d[
-                            'SerialNumber']} for d in
-                       response.json().get('Devices')]
-            return devices
+        return self.get_device_inventory().summaries()
 
     def get_available_devices(self):
-        return [d for d in self.get_all_devices()
-                if d['username'] == '' or d['username'] == 'staging']
+        return self.get_device_inventory().available()
 
     @classmethod
     def get_serializer_data(cls, **data):
@@ -582,18 +675,234 @@ class TenantServiceAsset(PropertyTable):
         unique_together = ('service', 'asset')
 
 
+class ProvisioningJobQuerySet(models.QuerySet):
+    def enqueue(self, user, editor, provision_data):
+        return self.create(user=user, editor=editor, changes=dict(
+            (field, [obj.pk for obj in objects]) for field, objects in provision_data.items()
+        ))
+
+    def enqueue_registration(self, user, service):
+        # Written in the transaction that creates the user, so that the job
+        # only becomes visible to workers once the user is committed, and
+        # goes away with it if that transaction is rolled back.
+        return self.create(
+            user=user, action=ProvisioningJob.ACTION.register,
+            changes={'services': [service.pk]}
+        )
+
+    def requeue_stale(self, timeout=None):
+        # Running jobs save their progress as they go, so one that was not
+        # modified for that long has lost its worker. Jobs are planned against
+        # the user's current state, so running one again only redoes what is
+        # still missing.
+        timeout = PROVISIONING_JOB_TIMEOUT if timeout is None else timeout
+        now = datetime.datetime.now()
+        return self.filter(
+            status=ProvisioningJob.STATUS.running,
+            modified__lt=now - datetime.timedelta(seconds=timeout)
+        ).update(status=ProvisioningJob.STATUS.queued, status_changed=now, modified=now)
+
+    def claim(self):
+        # Compare-and-set on the status, so that of several workers picking
+        # the same job only the one whose update went through runs it. Jobs
+        # of one user run one at a time, as each is planned against the state
+        # the previous one left: users with a running job are skipped, and of
+        # two jobs claimed for one user at the same time the older one runs.
+        self.requeue_stale()
+        while True:
+            now = datetime.datetime.now()
+            candidate = self.filter(
+                models.Q(run_after__isnull=True) | models.Q(run_after__lte=now),
+                status=ProvisioningJob.STATUS.queued
+            ).exclude(
+                user__in=self.filter(status=ProvisioningJob.STATUS.running).values('user_id')
+            ).order_by('created', 'pk').values_list('pk', 'user_id').first()
+            if candidate is None:
+                return None
+            pk, user_id = candidate
+            now = datetime.datetime.now()
+            claimed = self.filter(pk=pk, status=ProvisioningJob.STATUS.queued).update(
+                status=ProvisioningJob.STATUS.running, status_changed=now, modified=now
+            )
+            if claimed != 1:
+                continue
+            first = self.filter(user_id=user_id, status=ProvisioningJob.STATUS.running).order_by(
+                'created', 'pk').values_list('pk', flat=True).first()
+            if first == pk:
+                return self.get(pk=pk)
+            self.filter(pk=pk, status=ProvisioningJob.STATUS.running).update(
+                status=ProvisioningJob.STATUS.queued, status_changed=now, modified=now
+            )
+
+
+class ProvisioningJob(TimeStampedModel, StatusModel):
+    STATUS = Choices('queued', 'running', 'completed', 'failed')
+    ACTION = Choices('provision', 'register')
+    ASSET_CLASSES = {'software': Software, 'devices': Device, 'simcards': MobileDataPlan}
+
+    objects = models.Manager.from_queryset(ProvisioningJobQuerySet)()
+
+    user = models.ForeignKey(User, related_name='provisioning_jobs')
+    editor = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, related_name='+')
+    action = models.CharField(max_length=20, choices=ACTION, default=ACTION.provision)
+    changes = JSONField()
+    progress = JSONField(default=list)
+    error = models.TextField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    @property
+    def tenant(self):
+        return self.user.tenant
+
+    @property
+    def services(self):
+        return list(self.user.tenant.tenantservice_set.filter(
+            pk__in=self.changes.get('services', [])
+        ).select_subclasses())
+
+    def retry(self, delay):
+        self.attempts += 1
+        self.run_after = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.status = self.STATUS.queued
+        self.save()
+
+    @property
+    def provision_data(self):
+        data = {}
+        for field, ids in self.changes.items():
+            if field == 'platforms':
+                data[field] = list(self.user.tenant.tenantservice_set.filter(pk__in=ids))
+            else:
+                data[field] = self.ASSET_CLASSES[field].objects.filter(pk__in=ids)
+        return data
+
+    def __unicode__(self):
+        return 'Provisioning job %s for %s (%s)' % (self.pk, self.user, self.status)
+
+
+class LastSeenEventQuerySet(models.QuerySet):
+    def ingest(self, events, batch_size=None):
+        events = dict((e.key, e) for e in events).values()
+        batch_size = batch_size or self.model.INGEST_BATCH_SIZE
+        created = []
+        with transaction.atomic():
+            for idx in xrange(0, len(events), batch_size):
+                batch = events[idx:idx + batch_size]
+                existing = set(self.filter(
+                    user__in=set(e.user_id for e in batch),
+                    item_type__in=set(e.item_type_id for e in batch),
+                    object_id__in=set(e.object_id for e in batch),
+                    last_seen__gte=min(e.last_seen for e in batch),
+                    last_seen__lte=max(e.last_seen for e in batch)
+                ).values_list('user_id', 'item_type_id', 'object_id', 'last_seen'))
+                new_events = [e for e in batch if e.key not in existing]
+                self.bulk_create(new_events)
+                LastSeenSummary.objects.record(new_events)
+                created.extend(new_events)
+        return created
+
+
 class LastSeenEvent(TimeStampedModel):
+    INGEST_BATCH_SIZE = 500
+
+    objects = models.Manager.from_queryset(LastSeenEventQuerySet)()
+
     user = models.ForeignKey(User)
     item_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     item = GenericForeignKey('item_type', 'object_id')
     last_seen = models.DateTimeField()
 
+    @property
+    def key(self):
+        return (self.user_id, self.item_type_id, self.object_id, self.last_seen)
+
+    class Meta:
+        unique_together = ('user', 'item_type', 'object_id', 'last_seen')
+
+
+class LastSeenSummaryQuerySet(models.QuerySet):
+    def record(self, events):
+        latest = {}
+        for event in events:
+            key = (event.user_id, event.item_type_id, event.object_id)
+            if key not in latest or latest[key] < event.last_seen:
+                latest[key] = event.last_seen
+        if not latest:
+            return
+
+        current = dict(
+            ((s.user_id, s.item_type_id, s.object_id), s) for s in self.filter(
+                user__in=set(k[0] for k in latest),
+                item_type__in=set(k[1] for k in latest),
+                object_id__in=set(k[2] for k in latest)
+            )
+        )
+        new_summaries = []
+        for key, last_seen in latest.items():
+            summary = current.get(key)
+            if summary is None:
+                new_summaries.append(self.model(
+                    user_id=key[0], item_type_id=key[1], object_id=key[2], last_seen=last_seen
+                ))
+            elif summary.last_seen < last_seen:
+                self.filter(pk=summary.pk).update(last_seen=last_seen)
+        self.bulk_create(new_summaries)
+
+
+class LastSeenSummary(models.Model):
+    objects = models.Manager.from_queryset(LastSeenSummaryQuerySet)()
+
+    user = models.ForeignKey(User)
+    item_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    item = GenericForeignKey('item_type', 'object_id')
+    last_seen = models.DateTimeField(db_index=True)
+
+    @property
+    def tenant(self):
+        return self.user.tenant
+
+    def __unicode__(self):
+        return '%s last seen on %s at %s' % (self.user, self.item, self.last_seen)
+
+    class Meta:
+        unique_together = ('user', 'item_type', 'object_id')
+
+
+class LastSeenEventBuffer(object):
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or LastSeenEvent.INGEST_BATCH_SIZE
+        self._events = {}
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, user, item_type, object_id, last_seen):
+        event = LastSeenEvent(
+            user=user, item_type=item_type, object_id=object_id, last_seen=last_seen
+        )
+        self._events.setdefault(event.key, event)
+
+    def flush(self):
+        events, self._events = self._events.values(), {}
+        return LastSeenEvent.objects.ingest(events, batch_size=self.batch_size)
+
 
 item_provisioned.connect(UserProvisionHistory.on_provision,
                          dispatch_uid='provision')
 item_deprovisioned.connect(UserProvisionHistory.on_deprovision,
                            dispatch_uid='deprovision')
+post_save.connect(InventoryEntry.on_change, dispatch_uid='inventory_save',
+                  sender=InventoryEntry)
+post_delete.connect(InventoryEntry.on_change, dispatch_uid='inventory_delete',
+                    sender=InventoryEntry)
+post_save.connect(TenantAsset.on_change, dispatch_uid='tenant_asset_save', sender=TenantAsset)
+post_delete.connect(TenantAsset.on_change, dispatch_uid='tenant_asset_delete', sender=TenantAsset)
+post_save.connect(Device.on_change, dispatch_uid='device_save', sender=Device)
+post_save.connect(Device.on_change, dispatch_uid='chrome_device_save', sender=ChromeDevice)
+post_save.connect(Device.on_change, dispatch_uid='asset_device_save', sender=Asset)
 
 if not getattr(settings, 'PROVISIONABLE_SERVICES'):
     settings.PROVISIONABLE_SERVICES = [
@@ -16,8 +16,36 @@
 # limitations under the License.
 import re
 import json
+import time
+import random
+import logging
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+# Connection pool settings for the clients kept in the registry. Each
+# client holds at most POOL_MAXSIZE keep-alive connections to its org.
+POOL_CONNECTIONS = 1
+POOL_MAXSIZE = 10
+
+# Okta rate limits are applied per endpoint family (users, apps, events...).
+# Requests are held back when fewer than RATE_LIMIT_RESERVE calls are left
+# in the current window, and a 429 is retried up to RATE_LIMIT_RETRIES times.
+RATE_LIMIT_RESERVE = 2
+RATE_LIMIT_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Default number of records requested per page on listing endpoints.
+PAGE_SIZE = 200
+
+# The System Log keeps events for 90 days, but is only searched for the
+# last 7 days unless a `since` is given.
+SSO_LOOKBACK_DAYS = 90
+LOG_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
 
 # FIXME: The check_for_error, check_is_known_error response should be
 # refactored to use the check_exception_response decorator.
@@ -158,28 +186,125 @@ class Application(Resource):
         response.raise_for_status()
 
 
+class RateLimiter(object):
+    def __init__(self, reserve=RATE_LIMIT_RESERVE):
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._wait_time = {}
+        self._throttled = {}
+
+    @staticmethod
+    def family(url):
+        return url.strip('/').split('?', 1)[0].split('/', 1)[0]
+
+    def acquire(self, family):
+        delay = 0
+        with self._lock:
+            remaining, reset_at = self._buckets.get(family, (None, None))
+            if remaining is not None:
+                if reset_at <= time.time():
+                    del self._buckets[family]
+                else:
+                    if remaining <= self.reserve:
+                        delay = reset_at - time.time() + random.uniform(0, 1)
+                    self._buckets[family] = (remaining - 1, reset_at)
+        if delay > 0:
+            self._wait(family, delay)
+
+    def update(self, family, response):
+        try:
+            remaining = int(response.headers['X-Rate-Limit-Remaining'])
+            reset_at = float(response.headers['X-Rate-Limit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._buckets[family] = (remaining, reset_at)
+
+    def backoff(self, family, response, attempt):
+        with self._lock:
+            self._throttled[family] = self._throttled.get(family, 0) + 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+        try:
+            delay = max(delay, float(response.headers['X-Rate-Limit-Reset']) - time.time())
+        except (KeyError, TypeError, ValueError):
+            pass
+        self._wait(family, delay + random.uniform(0, delay / 2))
+
+    def _wait(self, family, delay):
+        log.debug('Okta rate limit reached for %s, waiting %.2fs' % (family, delay))
+        with self._lock:
+            self._wait_time[family] = self._wait_time.get(family, 0) + delay
+        time.sleep(delay)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict((family, {
+                'wait_time': self._wait_time.get(family, 0),
+                'throttled': self._throttled.get(family, 0)
+                }) for family in set(self._wait_time) | set(self._throttled))
+
+
 class Client(object):
-    def __init__(self, domain, api_token):
+    def __init__(self, domain, api_token, pool_connections=POOL_CONNECTIONS,
+                 pool_maxsize=POOL_MAXSIZE):
         self.domain = domain
         self.api_token = api_token
+        self.rate_limiter = RateLimiter()
         self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=True
+            ))
         self._session.headers.update({
             'Accept': 'application/json',
             'Authorization': 'SSWS %s' % self.api_token,
+            'Connection': 'keep-alive',
             'Content-Type': 'application/json'
             })
 
+    def close(self):
+        self._session.close()
+
     def _make_request(self, url, method=None, data=None, **kw):
         if data is not None:
             kw['data'] = json.dumps(data)
 
-        full_url = 'https://%s.okta.com/api/v1/%s' % (self.domain, url)
-        return {
+        base_url = 'https://%s.okta.com/api/v1/' % self.domain
+        if url.startswith(base_url):
+            url = url[len(base_url):]
+        full_url = base_url + url
+        send = {
             'GET': self._session.get,
             'PUT': self._session.put,
             'POST': self._session.post,
             'DELETE': self._session.delete
-            }.get(method, self._session.get)(full_url, **kw)
+            }.get(method, self._session.get)
+
+        family = self.rate_limiter.family(url)
+        for attempt in xrange(RATE_LIMIT_RETRIES + 1):
+            self.rate_limiter.acquire(family)
+            response = send(full_url, **kw)
+            self.rate_limiter.update(family, response)
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                return response
+            self.rate_limiter.backoff(family, response, attempt)
+
+    def _paginate(self, url, params=None, limit=PAGE_SIZE):
+        params = dict(params or {})
+        if limit is not None:
+            params['limit'] = limit
+        response = self._make_request(url, method='GET', params=params)
+        while True:
+            response.raise_for_status()
+            for it in response.json():
+                yield it
+            next_url = response.links.get('next', {}).get('url')
+            if not next_url:
+                break
+            response = self._make_request(next_url, method='GET')
 
     def search(self, resource_cls, query_string):
         response = self._make_request(resource_cls.ENDPOINT_ROOT, params={'q': query_string})
@@ -197,10 +322,11 @@ class Client(object):
     def assign_application_to_user(self, application, user, profile=None):
         application.assign_to_user(user, profile=profile)
 
-    def get_users(self):
-        response = self._make_request('users', method='GET')
-        response.raise_for_status()
-        return response.json()
+    def get_users(self, limit=PAGE_SIZE):
+        return self._paginate('users', limit=limit)
+
+    def get_events(self, params=None, limit=PAGE_SIZE):
+        return self._paginate('events', params=params, limit=limit)
 
     def add_user(self, user, activate=True):
         user_profile_data = {
@@ -243,20 +369,26 @@ class Client(object):
         response.raise_for_status()
         return response.json()
 
-    def last_sso_event(self, user, app):
+    def last_sso_event(self, user, app, since=None):
+        # The System Log can be sorted newest first, so only one record is
+        # fetched. `since` is a naive UTC datetime; without it Okta only
+        # looks at the last 7 days.
         filter_strings = [
-            'action.objectType eq "app.auth.sso"',
-            'target.id eq "%s"' % user,
+            'eventType eq "user.authentication.sso"',
+            'actor.id eq "%s"' % user,
             'target.id eq "%s"' % app
             ]
-        params = {'filter': ' and '.join(filter_strings)}
-        response = self._make_request('events', method='GET', params=params)
+        params = {
+            'filter': ' and '.join(filter_strings),
+            'sortOrder': 'DESCENDING',
+            'limit': 1
+            }
+        if since is not None:
+            params['since'] = since.strftime(LOG_TIME_FORMAT)
+        response = self._make_request('logs', method='GET', params=params)
         response.raise_for_status()
-        json = response.json()
-        if len(json) == 0:
-            return None
-        else:
-            return json[-1]
+        events = response.json()
+        return events[0] if events else None
 
     def user_applications(self, user):
         params = {'filter': 'user.id eq "%s"' % (user.id)}
@@ -264,3 +396,23 @@ class Client(object):
         response.raise_for_status()
         #print response.headers
         return response.json()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(domain, api_token):
+    key = (domain, api_token)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = Client(domain, api_token)
+        return client
+
+
+def discard_client(domain, api_token):
+    with _clients_lock:
+        client = _clients.pop((domain, api_token), None)
+    if client is not None:
+        client.close()
@@ -32,12 +32,39 @@ SERVICE_MODELS = dict([(s.slug, s.model_class) for s in __services])
 
 BASE_PLATFORM_FIELDS = ['url', 'is_active', 'api_token', 'type', 'service', 'name']
 
+SUMMARY_ASSET_CLASSES = {
+    'devices': models.Device,
+    'software': models.Software,
+    'simcards': models.MobileDataPlan
+}
+
 
 def make_new_service(service_type, tenant, api_token, active, *args, **kw):
     klass = SERVICE_MODELS.get(service_type)
     return klass.make(tenant, api_token, active, **kw)
 
 
+def make_provision_summary(users):
+    provisioned = models.UserProvisionable.objects.provisioned_assets(
+        users, SUMMARY_ASSET_CLASSES.values()
+    )
+    user_services = User.services.through.objects.filter(
+        user__in=users
+    ).values_list('user_id', 'tenantservice__platform_type')
+
+    summary = {}
+    for user_id, assets in provisioned.items():
+        summary[user_id] = dict(
+            (field, assets[klass]) for field, klass in SUMMARY_ASSET_CLASSES.items()
+        )
+    for user_id, platform_type in user_services:
+        user_summary = summary.setdefault(
+            user_id, dict((field, []) for field in SUMMARY_ASSET_CLASSES)
+        )
+        user_summary.setdefault('platforms', set()).add(platform_type)
+    return summary
+
+
 class UserModelChoiceField(serializers.PrimaryKeyRelatedField):
     many = True
 
@@ -180,69 +207,26 @@ class UserProvisionSerializer(serializers.ModelSerializer):
     devices = UserAssetChoiceField(asset=models.Device)
     simcards = UserAssetChoiceField(asset=models.MobileDataPlan)
 
-    def _get_selected_platforms(self):
-        return [s.__subclassed__ for s in self.object._provision_data.get('platforms', [])]
-
-    def _update_provisioned(self, field_name, service, editor):
-        provision_data = getattr(self.object, '_provision_data', {})
-        services = self._get_selected_platforms()
-
-        if field_name not in provision_data:
-            return
-
-        item_class = self.fields[field_name].asset_class
-        selected = self.object._provision_data.get(field_name)
-        current = self.object.get_provisioned_items(item_class=item_class, service=service)
-
-        to_add = [
-            item for item in [it.__subclassed__ for it in selected if it not in current]
-            if item.can_be_managed_by(service) and service in services
-        ]
-
-        to_remove = current if service not in services else [item for item in [
-            it.__subclassed__ for it in current if it not in selected]
-            if item.can_be_managed_by(service)
-        ]
-
-        for item in to_add:
-            log.debug('Adding %s to %s' % (item, service))
-            item.provision(service, self.object, editor=editor)
-
-        for item in to_remove:
-            log.debug('Removing %s from %s' % (item, service))
-            item.deprovision(service, self.object, editor=editor)
-
     def restore_object(self, attrs, instance=None):
         if instance is not None:
             instance._provision_data = attrs
         return instance
 
-    def save_object(self, obj, **kw):
-        request = self.context.get('request')
-        editor = request.user
-
-        for service in obj.tenant.tenantservice_set.select_subclasses():
-            self._update_provisioned('software', service, editor)
-            self._update_provisioned('devices', service, editor)
-            self._update_provisioned('simcards', service, editor)
-
-        current_services = obj.services.select_subclasses()
-        new_services = self._get_selected_platforms()
-        services_to_add = [s for s in new_services if s not in current_services]
-        services_to_remove = [s for s in current_services if s not in new_services]
+    class Meta:
+        model = User
+        fields = ('platforms', 'software', 'devices', 'simcards')
 
-        for service in services_to_add:
-            service.activate(obj, editor=editor)
 
-        for service in services_to_remove:
-            service.deactivate(obj, editor=editor)
+class ProvisioningJobSerializer(serializers.ModelSerializer):
+    url = serializers.HyperlinkedIdentityField(view_name='provisioning-job-detail')
+    progress = serializers.SerializerMethodField('get_progress')
 
-        obj.save(editor=editor)
-        return obj
+    def get_progress(self, obj):
+        return obj.progress
 
     class Meta:
-        model = User
-        fields = ('platforms', 'software', 'devices', 'simcards')
+        model = models.ProvisioningJob
+        fields = ('url', 'id', 'user', 'action', 'status', 'created', 'modified', 'progress', 'error')
 
 
 class UserSummarySerializer(serializers.ModelSerializer):
@@ -258,26 +242,29 @@ class UserSummarySerializer(serializers.ModelSerializer):
             'name': asset.name
         }
 
+    def _get_summary(self, obj):
+        summary = self.context.get('provision_summary')
+        if summary is None:
+            if not hasattr(obj, '_provision_summary'):
+                obj._provision_summary = make_provision_summary([obj]).get(obj.id, {})
+            return obj._provision_summary
+        return summary.get(obj.id, {})
+
+    def _serialize_provisioned(self, obj, field_name):
+        assets = sorted(self._get_summary(obj).get(field_name, []), key=lambda a: a.id)
+        return [self._serialize_asset(it) for it in assets]
+
     def get_user_devices(self, obj):
-        return [
-            self._serialize_asset(it)
-            for it in obj.get_provisioned_items(item_class=models.Device)
-        ]
+        return self._serialize_provisioned(obj, 'devices')
 
     def get_user_software(self, obj):
-        return [
-            self._serialize_asset(it)
-            for it in obj.get_provisioned_items(item_class=models.Software)
-        ]
+        return self._serialize_provisioned(obj, 'software')
 
     def get_user_mobile_data_plans(self, obj):
-        return [
-            self._serialize_asset(it)
-            for it in obj.get_provisioned_items(item_class=models.MobileDataPlan)
-        ]
+        return self._serialize_provisioned(obj, 'simcards')
 
     def get_user_platforms(self, obj):
-        provisioned = set([svc.type for svc in obj.services.all()])
+        provisioned = self._get_summary(obj).get('platforms', set())
         return {k: k in provisioned for k in models.TenantService.PLATFORM_TYPES}
 
     class Meta:
@@ -308,3 +295,12 @@ class InventoryEntrySerializer(serializers.ModelSerializer):
     class Meta:
         model = models.InventoryEntry
         fields = ('id', 'user', 'tenant_asset', 'serial_number', 'status', 'device_id')
+
+
+class LastSeenSummarySerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+    item_type = serializers.CharField(source='item_type.model', read_only=True)
+
+    class Meta:
+        model = models.LastSeenSummary
+        fields = ('id', 'user', 'username', 'item_type', 'object_id', 'last_seen')
@@ -16,14 +16,35 @@
 # limitations under the License.
 
 
+import datetime
+import os
 import random
+import shutil
+import tempfile
+import threading
+import time
 
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.db import connection, transaction
+from django.db import models as django_models
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
 
 from tenants import factories
 from audit.models import UntrackableChangeError
+from contrib.models import subclass_cache
+from tenants import tasks
+from tenants.models import TenantService, User
+import devices
+import executor
+import google
 import models
+import okta
+import serializers
+import views
 
 
 class TrackableTestCaseMixin(object):
@@ -72,3 +93,780 @@ class UserTestCase(TestCase, TrackableTestCaseMixin):
     #     self.assertTrue(self.tracked_item.has_access_to_platform(platform))
     #     self.tracked_item.revoke_platform(platform, editor=self.editor)
     #     self.assertFalse(self.tracked_item.has_access_to_platform(platform))
+
+
+class UserSummaryTestCase(TestCase):
+    TOTAL_USERS = 20
+    MAX_QUERIES = 8
+
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        self.okta = models.Okta.objects.create(
+            tenant=self.tenant, api_token='token', domain='example'
+        )
+        self.software = models.Software.objects.create(name='Office365')
+        self.device = models.Device.objects.create(name='iPhone')
+
+        for idx in xrange(self.TOTAL_USERS):
+            user = factories.UserFactory.build(tenant=self.tenant, username='user%03d' % idx)
+            django_models.Model.save(user)
+            user.services.add(self.okta)
+            for asset in [self.software, self.device]:
+                models.UserProvisionable.objects.create(
+                    user=user,
+                    service=self.okta,
+                    item_type=ContentType.objects.get_for_model(asset),
+                    object_id=asset.id
+                )
+
+    def testSummaryQueryCountDoesNotDependOnUsers(self):
+        users = self.tenant.user_set.all()
+        with CaptureQueriesContext(connection) as context:
+            summary = serializers.make_provision_summary(users)
+            data = serializers.UserSummarySerializer(
+                users, many=True, context={'provision_summary': summary}
+            ).data
+        self.assertEqual(len(data), self.TOTAL_USERS)
+        self.assertTrue(len(context.captured_queries) <= self.MAX_QUERIES)
+
+    def testSummaryMatchesProvisionedItems(self):
+        users = self.tenant.user_set.all()
+        summary = serializers.make_provision_summary(users)
+        for entry in serializers.UserSummarySerializer(
+                users, many=True, context={'provision_summary': summary}).data:
+            self.assertEqual(entry['software'], [{'id': self.software.id, 'name': 'Office365'}])
+            self.assertEqual(entry['devices'], [{'id': self.device.id, 'name': 'iPhone'}])
+            self.assertEqual(entry['simcards'], [])
+            self.assertTrue(entry['platforms']['web'])
+            self.assertFalse(entry['platforms']['mobile'])
+
+    def testPaginatedListSummarizesThePage(self):
+        request = APIRequestFactory().get('/', {'page_size': 5, 'page': 2})
+        force_authenticate(request, user=self.tenant.primary_contact)
+        with CaptureQueriesContext(connection) as context:
+            response = views.UserProvisionStatusListView.as_view()(request)
+            response.render()
+
+        self.assertEqual(response.data['count'], self.TOTAL_USERS)
+        self.assertEqual(len(response.data['results']), 5)
+        for entry in response.data['results']:
+            self.assertEqual(entry['software'], [{'id': self.software.id, 'name': 'Office365'}])
+            self.assertTrue(entry['platforms']['web'])
+        self.assertEqual(len([q for q in context.captured_queries if 'LIMIT' in q['sql']]), 1)
+
+
+class OktaClientRegistryTestCase(TestCase):
+    def setUp(self):
+        self.okta = models.Okta.objects.create(
+            tenant=factories.TenantFactory(), api_token='token', domain='example'
+        )
+
+    def testClientIsReused(self):
+        self.assertTrue(self.okta.get_client() is self.okta.get_client())
+
+    def testClientIsReplacedWhenTokenChanges(self):
+        client = self.okta.get_client()
+        self.okta.api_token = 'new-token'
+        self.okta.save()
+        new_client = self.okta.get_client()
+        self.assertFalse(client is new_client)
+        self.assertEqual(new_client.api_token, 'new-token')
+
+
+class FakeOktaResponse(object):
+    def __init__(self, data, status_code=200, headers=None, next_url=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.links = {'next': {'url': next_url}} if next_url else {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP %d' % self.status_code)
+
+    def json(self):
+        return self.data
+
+
+class FakeOktaSession(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, **kw):
+        self.requests.append((url, kw))
+        return self.responses.pop(0)
+
+
+class OktaClientTestCase(SimpleTestCase):
+    def setUp(self):
+        self.client = okta.Client('example', 'token')
+
+    def _respond(self, *responses):
+        self.client._session = FakeOktaSession(responses)
+        return self.client._session.requests
+
+    def testPagesAreFollowedThroughLinkHeaders(self):
+        next_url = 'https://example.okta.com/api/v1/users?after=00u2&limit=2'
+        requests = self._respond(
+            FakeOktaResponse([{'id': '00u1'}, {'id': '00u2'}], next_url=next_url),
+            FakeOktaResponse([{'id': '00u3'}])
+        )
+        users = list(self.client.get_users(limit=2))
+        self.assertEqual([u['id'] for u in users], ['00u1', '00u2', '00u3'])
+        self.assertEqual(requests, [
+            ('https://example.okta.com/api/v1/users', {'params': {'limit': 2}}),
+            (next_url, {})
+        ])
+
+    def testFailedPagesRaise(self):
+        self._respond(
+            FakeOktaResponse([{'id': '00u1'}], next_url='https://example.okta.com/api/v1/users?after=00u1'),
+            FakeOktaResponse({'errorCode': 'E0000009'}, status_code=500)
+        )
+        self.assertRaises(Exception, list, self.client.get_users())
+
+    def testSsoEventsAreSearchedSince(self):
+        requests = self._respond(FakeOktaResponse([{'published': '2014-12-02T10:00:00.000Z'}]))
+        event = self.client.last_sso_event('00u1', '0oa1', since=datetime.datetime(2014, 12, 1, 8, 30))
+        self.assertEqual(event['published'], '2014-12-02T10:00:00.000Z')
+        url, kw = requests[0]
+        self.assertEqual(url, 'https://example.okta.com/api/v1/logs')
+        self.assertEqual(kw['params']['since'], '2014-12-01T08:30:00.000Z')
+        self.assertEqual(kw['params']['limit'], 1)
+
+    def _record_waits(self):
+        waits = []
+        self.client.rate_limiter._wait = lambda family, delay: waits.append(delay)
+        return waits
+
+    def testThrottledRequestsAreRetriedWithBackoff(self):
+        waits = self._record_waits()
+        requests = self._respond(
+            FakeOktaResponse({}, status_code=429),
+            FakeOktaResponse({}, status_code=429),
+            FakeOktaResponse({'id': '00u1'})
+        )
+        self.assertEqual(self.client._make_request('users/00u1').json(), {'id': '00u1'})
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(len(waits), 2)
+        self.assertTrue(okta.BACKOFF_BASE <= waits[0] <= 1.5 * okta.BACKOFF_BASE)
+        self.assertTrue(2 * okta.BACKOFF_BASE <= waits[1] <= 3 * okta.BACKOFF_BASE)
+        self.assertEqual(self.client.rate_limiter.stats['users']['throttled'], 2)
+
+    def testThrottledRequestsGiveUpAfterTheLastRetry(self):
+        waits = self._record_waits()
+        requests = self._respond(*[
+            FakeOktaResponse({}, status_code=429) for _ in range(okta.RATE_LIMIT_RETRIES + 1)
+        ])
+        self.assertEqual(self.client._make_request('users/00u1').status_code, 429)
+        self.assertEqual(len(requests), okta.RATE_LIMIT_RETRIES + 1)
+        self.assertEqual(len(waits), okta.RATE_LIMIT_RETRIES)
+
+
+class RateLimiterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.limiter = okta.RateLimiter(reserve=2)
+        self.waits = []
+        self.limiter._wait = lambda family, delay: self.waits.append((family, delay))
+
+    def _window(self, remaining, reset_in):
+        self.limiter.update('users', FakeOktaResponse({}, headers={
+            'X-Rate-Limit-Remaining': '%d' % remaining,
+            'X-Rate-Limit-Reset': '%d' % (time.time() + reset_in)
+        }))
+
+    def testRequestsAreHeldOnceTheBudgetIsSpent(self):
+        self._window(4, 30)
+        self.limiter.acquire('users')
+        self.limiter.acquire('users')
+        self.assertEqual(self.waits, [])
+
+        self.limiter.acquire('users')
+        self.limiter.acquire('apps')
+        self.assertEqual([family for family, _ in self.waits], ['users'])
+        self.assertTrue(28 <= self.waits[0][1] <= 31)
+
+    def testExpiredWindowsAreForgotten(self):
+        self._window(0, -1)
+        self.limiter.acquire('users')
+        self.assertEqual(self.waits, [])
+
+    def testFamiliesAreTheFirstPathSegment(self):
+        self.assertEqual(okta.RateLimiter.family('/users/00u1/groups?limit=2'), 'users')
+        self.assertEqual(okta.RateLimiter.family('apps?filter=x'), 'apps')
+
+
+class TenantServiceColumnsTestCase(TestCase):
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        self.okta = models.Okta.objects.create(
+            tenant=self.tenant, api_token='token', domain='example'
+        )
+
+    def testPlatformTypeAndSlugAreStored(self):
+        service = TenantService.objects.get(pk=self.okta.pk)
+        self.assertEqual((service.platform_type, service.slug), ('web', 'okta'))
+        with self.assertNumQueries(0):
+            self.assertEqual(service.type, 'web')
+
+    def testGetServiceFiltersOnSlug(self):
+        self.assertEqual(self.tenant.get_service('okta'), self.okta)
+        self.assertEqual(self.tenant.get_service('airwatch'), None)
+
+    def testOnlyOneActiveServicePerPlatform(self):
+        other = models.Okta(tenant=self.tenant, api_token='other', domain='other')
+        self.assertRaises(ValidationError, other.validate_unique)
+        other.is_active = False
+        other.validate_unique()
+
+
+class LastSeenEventIngestionTestCase(TestCase):
+    def setUp(self):
+        tenant = factories.TenantFactory()
+        self.user = factories.UserFactory.build(tenant=tenant, username='user')
+        django_models.Model.save(self.user)
+        self.okta = models.Okta.objects.create(tenant=tenant, api_token='token', domain='example')
+        self.item_type = ContentType.objects.get_for_model(self.okta)
+
+    def _buffer(self, *timestamps):
+        events = models.LastSeenEventBuffer(batch_size=2)
+        for timestamp in timestamps:
+            events.add(self.user, self.item_type, self.okta.id, timestamp)
+        return events
+
+    def testDuplicatesAreSkipped(self):
+        first = datetime.datetime(2014, 12, 1, 8, 30)
+        second = datetime.datetime(2014, 12, 2, 9, 15)
+        self.assertEqual(len(self._buffer(first, first, second).flush()), 2)
+        self.assertEqual(len(self._buffer(first, second).flush()), 0)
+        self.assertEqual(models.LastSeenEvent.objects.count(), 2)
+
+
+class LastSeenSummaryListViewTestCase(TestCase):
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        self.okta = models.Okta.objects.create(tenant=self.tenant, api_token='token', domain='example')
+        self.item_type = ContentType.objects.get_for_model(self.okta)
+        self.users = []
+        for username in ['seen', 'other']:
+            user = factories.UserFactory.build(tenant=self.tenant, username=username)
+            django_models.Model.save(user)
+            self.users.append(user)
+        stranger = factories.UserFactory.build(tenant=factories.TenantFactory(), username='stranger')
+        django_models.Model.save(stranger)
+
+        for idx, user in enumerate(self.users + [stranger]):
+            models.LastSeenSummary.objects.create(
+                user=user, item_type=self.item_type, object_id=self.okta.id,
+                last_seen=datetime.datetime(2014, 12, 1 + idx, 8, 30)
+            )
+
+    def _get(self, **params):
+        request = APIRequestFactory().get('/', params)
+        force_authenticate(request, user=self.tenant.primary_contact)
+        return views.LastSeenSummaryListView.as_view()(request)
+
+    def testListsSummariesOfTheTenant(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['username'] for r in response.data['results']], ['seen', 'other'])
+
+    def testFiltersByUserAndDate(self):
+        response = self._get(user=self.users[1].id)
+        self.assertEqual([r['username'] for r in response.data['results']], ['other'])
+        response = self._get(before='2014-12-02')
+        self.assertEqual([r['username'] for r in response.data['results']], ['seen'])
+
+    def testInvalidFiltersAreRejected(self):
+        self.assertEqual(self._get(user='seen').status_code, 400)
+        self.assertEqual(self._get(before='yesterday-ish').status_code, 400)
+
+    def testResultsArePaginated(self):
+        models.LastSeenSummary.objects.bulk_create([
+            models.LastSeenSummary(
+                user=self.users[0], item_type=self.item_type, object_id=object_id,
+                last_seen=datetime.datetime(2015, 1, 1, 8, 30)
+            )
+            for object_id in range(1000, 1000 + views.LastSeenSummaryListView.paginate_by)
+        ])
+        response = self._get()
+        self.assertEqual(response.data['count'], 52)
+        self.assertEqual(len(response.data['results']), 50)
+        response = self._get(page=2)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['next'], None)
+
+
+class SubclassResolutionTestCase(TestCase):
+    def setUp(self):
+        self.software = models.Software.objects.create(name='Office365')
+        self.device = models.Device.objects.create(name='iPhone')
+
+    def testResolvesOncePerObject(self):
+        asset = models.Asset.objects.get(pk=self.software.pk)
+        with self.assertNumQueries(1):
+            self.assertIsInstance(asset.__subclassed__, models.Software)
+            self.assertIsInstance(asset.__subclassed__, models.Software)
+
+    def testLeafInstancesResolveToThemselves(self):
+        with self.assertNumQueries(0):
+            self.assertIs(self.software.__subclassed__, self.software)
+
+    def testBulkResolutionUsesOneQuery(self):
+        assets = list(models.Asset.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            resolved = models.Asset.resolve_subclasses(assets)
+        self.assertEqual([type(a) for a in resolved], [models.Software, models.Device])
+
+    def testUnitOfWorkSharesResolvedInstances(self):
+        with subclass_cache():
+            models.Asset.objects.get(pk=self.device.pk).__subclassed__
+            asset = models.Asset.objects.get(pk=self.device.pk)
+            with self.assertNumQueries(0):
+                self.assertIsInstance(asset.__subclassed__, models.Device)
+
+
+class ProvisioningExecutorTestCase(TestCase):
+    def setUp(self):
+        tenant = factories.TenantFactory()
+        self.editor = tenant.primary_contact
+        self.user = factories.UserFactory.build(tenant=tenant, username='executor')
+        django_models.Model.save(self.user)
+        self.okta = models.Okta.objects.create(tenant=tenant, api_token='token', domain='example')
+        self.plan = models.MobileDataPlan.objects.create(name='Data')
+        self.broken = models.MobileDataPlan.objects.create(name='Broken')
+
+        def fail(service, user):
+            raise Exception('remote call failed')
+        self.broken.provision_remote = fail
+
+    def testRecordsSucceededOperationsAndReportsFailures(self):
+        runner = executor.ProvisioningExecutor(self.user, editor=self.editor)
+        succeeded = runner.run([
+            executor.Operation(executor.PROVISION, self.okta, self.plan),
+            executor.Operation(executor.PROVISION, self.okta, self.broken),
+        ])
+
+        self.assertEqual([op.item for op in succeeded], [self.plan])
+        self.assertEqual(
+            list(models.UserProvisionable.objects.filter(user=self.user).values_list('object_id', flat=True)),
+            [self.plan.id]
+        )
+        self.assertEqual(len(runner.errors), 1)
+        self.assertEqual(runner.errors[0]['item'], 'Broken')
+        self.assertEqual(runner.errors[0]['error'], 'remote call failed')
+
+    def testOktaFailuresAreReported(self):
+        software = models.Software.objects.create(name='Mail', web=True)
+
+        class Application(object):
+            def assign(self, service_user, profile=None):
+                raise Exception('application is gone')
+
+        class Client(object):
+            def get(self, resource, resource_id):
+                return Application()
+
+        self.okta.get_client = lambda: Client()
+        self.okta.get_service_user = lambda user: 'service user'
+        runner = executor.ProvisioningExecutor(self.user, editor=self.editor)
+        runner.run([executor.Operation(executor.PROVISION, self.okta, software)])
+
+        self.assertEqual([e['error'] for e in runner.errors], ['application is gone'])
+        self.assertTrue(self.okta.tenantserviceasset_set.filter(asset=software).exists())
+
+    def testServiceChangesAreRecordedOnTheCallingThread(self):
+        airwatch = models.AirWatch.objects.create(
+            tenant=self.user.tenant, api_token='token', username='admin',
+            password='secret', server_url='https://as.example.com', group_id='group'
+        )
+        remote_threads = []
+
+        def activate_remote(user):
+            remote_threads.append(threading.current_thread())
+        self.okta.activate_remote = activate_remote
+
+        def unreachable(user):
+            raise Exception('service unreachable')
+        airwatch.activate_remote = unreachable
+
+        runner = executor.ProvisioningExecutor(self.user, editor=self.editor)
+        self.assertEqual(runner.activate([self.okta, airwatch]), [self.okta])
+        self.assertFalse(threading.current_thread() in remote_threads)
+        self.assertEqual(list(self.user.services.values_list('pk', flat=True)), [self.okta.pk])
+        self.assertEqual([e['error'] for e in runner.errors], ['service unreachable'])
+
+
+class FakeAirWatchClient(object):
+    def __init__(self, devices):
+        self.devices = devices
+        self.requests = []
+
+    def call_api(self, method, endpoint, params=None):
+        self.requests.append(params)
+        start = params['page'] * params['pagesize']
+        return FakeResponse({
+            'Devices': self.devices[start:start + params['pagesize']],
+            'Total': len(self.devices)
+        })
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class AirWatchDeviceInventoryTestCase(TestCase):
+    def setUp(self):
+        self.airwatch = models.AirWatch.objects.create(
+            tenant=factories.TenantFactory(), api_token='token', username='admin',
+            password='secret', server_url='https://as.example.com', group_id='group'
+        )
+        owners = ['alice', 'Bob', 'alice', '', 'staging']
+        self.client = FakeAirWatchClient([
+            {'Model': 'iPhone 6', 'UserName': owner, 'SerialNumber': 'SN%d' % idx}
+            for idx, owner in enumerate(owners)
+        ])
+        self.airwatch.get_client = lambda: self.client
+
+    def testDevicesAreFetchedInPages(self):
+        inventory = self.airwatch.get_device_inventory(page_size=2)
+        self.assertEqual(len(inventory), 5)
+        self.assertEqual([r['page'] for r in self.client.requests], [0, 1, 2])
+
+    def testDevicesAreIndexedByUserAndSerial(self):
+        inventory = self.airwatch.get_device_inventory(page_size=2)
+        self.assertEqual([d['SerialNumber'] for d in inventory.for_user('alice')], ['SN0', 'SN2'])
+        self.assertEqual([d['SerialNumber'] for d in inventory.for_user('bob')], ['SN1'])
+        self.assertEqual(inventory.find('SN4')['UserName'], 'staging')
+        self.assertEqual(
+            [d['serial_number'] for d in self.airwatch.get_available_devices()], ['SN3', 'SN4']
+        )
+
+
+class DeviceProviderTestCase(SimpleTestCase):
+    def testFailingAndSlowProvidersBecomeWarnings(self):
+        release = threading.Event()
+
+        def broken():
+            raise Exception('unreachable')
+
+        def slow():
+            release.wait()
+            return [{'serial_number': 'late'}]
+
+        try:
+            result = devices.fetch_from_providers([
+                ('airwatch', lambda: [{'serial_number': 'SN1'}]),
+                ('google', broken),
+                ('mobileiron', slow)
+            ], timeout=0.1)
+        finally:
+            release.set()
+
+        self.assertEqual(result['devices'], [{'serial_number': 'SN1'}])
+        self.assertEqual(result['warnings'], [
+            {'provider': 'google', 'error': 'unreachable'},
+            {'provider': 'mobileiron', 'error': 'timed out after 0.1s'}
+        ])
+
+
+class AvailableDeviceCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tenant = factories.TenantFactory()
+        self.fetched = []
+        self.warnings = []
+
+    def _fetch(self, tenant):
+        self.fetched.append(tenant)
+        return {
+            'devices': [{'model': 'iPhone 6', 'username': '', 'serial_number': 'SN%d' % len(self.fetched)}],
+            'warnings': self.warnings
+        }
+
+    def _cache(self, ttl=60):
+        return devices.AvailableDeviceCache(self.tenant, self._fetch, ttl=ttl)
+
+    def testDevicesAreServedFromCache(self):
+        self.assertEqual(self._cache().get(), self._cache().get())
+        self.assertEqual(len(self.fetched), 1)
+
+    def testStaleDevicesAreServedWhileRefreshing(self):
+        self._cache().get()
+        stale = self._cache(ttl=0).get()
+        self.assertEqual(stale['devices'][0]['serial_number'], 'SN1')
+        tasks.wait_for_pending(timeout=5)
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(self._cache().get()['devices'][0]['serial_number'], 'SN2')
+
+    def testPartialResultsAreNotCached(self):
+        self.warnings = [{'provider': 'google', 'error': 'timed out after 10s'}]
+        self._cache().get()
+        self._cache().get()
+        self.assertEqual(len(self.fetched), 2)
+
+    def testHandingOutDevicesInvalidates(self):
+        self._cache().get()
+        user = factories.UserFactory.build(tenant=self.tenant, username='holder')
+        django_models.Model.save(user)
+        device = models.Device.objects.create(name='iPhone')
+        tenant_asset = models.TenantAsset.objects.create(tenant=self.tenant, asset=device)
+        models.InventoryEntry.objects.create(user=user, tenant_asset=tenant_asset, serial_number='SN1')
+        self._cache().get()
+        self.assertEqual(len(self.fetched), 2)
+
+
+class DeviceModelMatcherTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tenant = factories.TenantFactory()
+        self.iphone = self._tenant_asset(models.Device.objects.create(name='iPhone'))
+        self.ipad = self._tenant_asset(models.Device.objects.create(name='iPad'))
+        self._tenant_asset(models.Software.objects.create(name='Nexus'))
+
+    def _tenant_asset(self, asset):
+        return models.TenantAsset.objects.create(tenant=self.tenant, asset=asset)
+
+    def _annotate(self, *device_models):
+        matcher = devices.DeviceModelMatcher.for_tenant(self.tenant, views.load_device_assets)
+        return matcher.annotate([{'model': model} for model in device_models])
+
+    def testDevicesAreMatchedOnAssetNames(self):
+        with self.assertNumQueries(1):
+            annotated = self._annotate('Apple iPhone 6 Plus', 'IPAD AIR', 'Nexus 5')
+        self.assertEqual(annotated, [
+            {'model': 'Apple iPhone 6 Plus', 'tenant_asset_id': self.iphone.id, 'device_id': self.iphone.asset_id},
+            {'model': 'IPAD AIR', 'tenant_asset_id': self.ipad.id, 'device_id': self.ipad.asset_id},
+            {'model': 'Nexus 5'}
+        ])
+        with self.assertNumQueries(0):
+            self._annotate('iPhone 5')
+
+    def testMatcherFollowsAssetChanges(self):
+        self._annotate('Nexus 5')
+        nexus = self._tenant_asset(models.Device.objects.create(name='Nexus'))
+        self.assertEqual(self._annotate('Nexus 5')[0].get('tenant_asset_id'), nexus.id)
+
+        device = models.Device.objects.get(pk=nexus.asset_id)
+        device.name = 'Galaxy'
+        device.save()
+        self.assertEqual(self._annotate('Nexus 5'), [{'model': 'Nexus 5'}])
+
+    def testMatcherFollowsDevicesEditedAsAssets(self):
+        self._annotate('iPhone 6')
+        asset = models.Asset.objects.get(pk=self.iphone.asset_id)
+        asset.name = 'Galaxy'
+        asset.save()
+        self.assertEqual(self._annotate('iPhone 6'), [{'model': 'iPhone 6'}])
+        self.assertEqual(self._annotate('Galaxy S5')[0].get('tenant_asset_id'), self.iphone.id)
+
+    def testChromeDevicesAreNotMatched(self):
+        chromebook = self._tenant_asset(models.Device.objects.create(name='Chromebook'))
+        self.assertEqual(self._annotate('Chromebook Pixel'), [{'model': 'Chromebook Pixel'}])
+
+        device = models.ChromeDevice.objects.get(pk=chromebook.asset_id)
+        device.name = 'Pixel'
+        device.save()
+        self.assertEqual(self._annotate('Pixel 2')[0].get('tenant_asset_id'), chromebook.id)
+
+
+class GoogleClientRegistryTestCase(TestCase):
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        account = models.Software.objects.create(name='Google Account')
+        self.tenant_asset = models.TenantAsset.objects.create(tenant=self.tenant, asset=account)
+        for prop, value in [('CLIENT_EMAIL', 'service@example.org'),
+                            ('ADMINISTRATOR', 'admin@example.org'),
+                            ('CERTIFICATE_FILE_NAME', 'google.p12')]:
+            self.tenant_asset.set(prop, value)
+        self.tenant_asset.save()
+
+        self.client_class = google.Client
+
+        class Client(object):
+            def __init__(self, tenant, google_tenant_asset=None):
+                self.administrator_username = google_tenant_asset.get('ADMINISTRATOR')
+        google.Client = Client
+
+    def tearDown(self):
+        google.Client = self.client_class
+        google._clients.pop(self.tenant.pk, None)
+
+    def testClientIsReused(self):
+        self.assertTrue(google.get_client(self.tenant) is google.get_client(self.tenant))
+
+    def testClientIsRebuiltWhenSettingsChange(self):
+        client = google.get_client(self.tenant)
+        self.tenant_asset.set('ADMINISTRATOR', 'other@example.org')
+        self.tenant_asset.save()
+        new_client = google.get_client(self.tenant)
+        self.assertFalse(client is new_client)
+        self.assertEqual(new_client.administrator_username, 'other@example.org')
+
+
+class DiscoveryDocumentTestCase(SimpleTestCase):
+    def testStoredDocumentIsReadOnce(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'admin.directory_v1.json')
+        with open(path, 'w') as f:
+            f.write('{"name": "admin"}')
+        try:
+            self.assertEqual(google.discovery_document('admin', 'directory_v1', directory), '{"name": "admin"}')
+            os.remove(path)
+            self.assertEqual(google.discovery_document('admin', 'directory_v1', directory), '{"name": "admin"}')
+        finally:
+            shutil.rmtree(directory)
+
+
+class ProvisioningJobTestCase(TestCase):
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        self.user = factories.UserFactory.build(tenant=self.tenant, username='queued')
+        django_models.Model.save(self.user)
+        self.plan = models.MobileDataPlan.objects.create(name='Data')
+        models.TenantAsset.objects.create(tenant=self.tenant, asset=self.plan)
+
+    def testUpdateQueuesJob(self):
+        request = APIRequestFactory().put('/', {'simcards': [self.plan.id]}, format='json')
+        force_authenticate(request, user=self.tenant.primary_contact)
+        response = views.UserProvisionView.as_view()(request, pk=self.user.pk)
+
+        self.assertEqual(response.status_code, 202)
+        job = models.ProvisioningJob.objects.get()
+        self.assertEqual(job.status, models.ProvisioningJob.STATUS.queued)
+        self.assertEqual(job.changes['simcards'], [self.plan.id])
+        self.assertEqual(response['Location'], response.data['url'])
+
+    def testWorkerRunsQueuedJobs(self):
+        okta = models.Okta.objects.create(tenant=self.tenant, api_token='token', domain='example')
+        self.user.services.add(okta)
+        self.plan.web = True
+        self.plan.save()
+        job = models.ProvisioningJob.objects.enqueue(
+            self.user, self.tenant.primary_contact,
+            {'platforms': [okta], 'simcards': models.MobileDataPlan.objects.all()}
+        )
+        claimed = models.ProvisioningJob.objects.claim()
+        self.assertEqual(claimed, job)
+        self.assertEqual(claimed.status, models.ProvisioningJob.STATUS.running)
+        self.assertEqual(models.ProvisioningJob.objects.claim(), None)
+
+        executor.run_job(claimed)
+        job = models.ProvisioningJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, models.ProvisioningJob.STATUS.completed)
+        self.assertEqual(job.progress, [{
+            'action': executor.PROVISION, 'service': okta.service,
+            'item': 'Data', 'state': 'done', 'error': None
+        }])
+        self.assertEqual(
+            list(models.UserProvisionable.objects.filter(user=self.user).values_list('object_id', flat=True)),
+            [self.plan.id]
+        )
+
+    def _enqueue(self, user=None):
+        return models.ProvisioningJob.objects.enqueue(
+            user or self.user, self.tenant.primary_contact, {'simcards': []}
+        )
+
+    def _other_user(self):
+        user = factories.UserFactory.build(tenant=self.tenant, username='other')
+        django_models.Model.save(user)
+        return user
+
+    def testWorkersClaimDistinctJobs(self):
+        jobs = [self._enqueue(), self._enqueue(self._other_user())]
+        self.assertEqual(
+            [models.ProvisioningJob.objects.claim() for _ in range(3)], jobs + [None]
+        )
+
+    def testJobsOfOneUserRunOneAtATime(self):
+        first, second = self._enqueue(), self._enqueue()
+        other = self._enqueue(self._other_user())
+        self.assertEqual(models.ProvisioningJob.objects.claim(), first)
+        self.assertEqual(models.ProvisioningJob.objects.claim(), other)
+        self.assertEqual(models.ProvisioningJob.objects.claim(), None)
+
+        executor.run_job(first)
+        self.assertEqual(models.ProvisioningJob.objects.claim(), second)
+
+    def testStaleRunningJobsAreRequeued(self):
+        stale = models.ProvisioningJob.objects.enqueue(
+            self.user, self.tenant.primary_contact, {'simcards': []}
+        )
+        running = self._enqueue(self._other_user())
+        long_ago = datetime.datetime.now() - datetime.timedelta(seconds=models.PROVISIONING_JOB_TIMEOUT + 60)
+        models.ProvisioningJob.objects.filter(pk=stale.pk).update(
+            status=models.ProvisioningJob.STATUS.running, modified=long_ago
+        )
+        models.ProvisioningJob.objects.filter(pk=running.pk).update(
+            status=models.ProvisioningJob.STATUS.running
+        )
+
+        self.assertEqual(models.ProvisioningJob.objects.claim(), stale)
+        self.assertEqual(models.ProvisioningJob.objects.claim(), None)
+        self.assertEqual(
+            models.ProvisioningJob.objects.get(pk=running.pk).status, models.ProvisioningJob.STATUS.running
+        )
+
+
+class ServiceRegistrationTestCase(TestCase):
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        self.okta = models.Okta.objects.create(tenant=self.tenant, api_token='token', domain='example')
+        self.remote = None
+        self.registered = []
+
+        self.get_remote = vars(User).get('get_remote')
+        self.register = vars(models.Okta).get('register')
+        User.get_remote = lambda user: self.remote
+        models.Okta.register = lambda service, user: self.registered.append(user.username)
+
+    def tearDown(self):
+        User.get_remote = self.get_remote
+        models.Okta.register = self.register
+
+    def _create_user(self):
+        user = factories.UserFactory.build(tenant=self.tenant, username='new')
+        django_models.Model.save(user)
+        return user
+
+    def testNewUsersAreQueuedForRegistration(self):
+        user = self._create_user()
+        job = models.ProvisioningJob.objects.get()
+        self.assertEqual((job.user_id, job.action), (user.pk, models.ProvisioningJob.ACTION.register))
+        self.assertEqual(job.services, [self.okta])
+
+    def testRolledBackUsersAreNotRegistered(self):
+        try:
+            with transaction.atomic():
+                self._create_user()
+                raise RuntimeError('directory push failed')
+        except RuntimeError:
+            pass
+        self.assertFalse(models.ProvisioningJob.objects.exists())
+
+    def testRegistrationWaitsForActiveDirectory(self):
+        self._create_user()
+        executor.run_job(models.ProvisioningJob.objects.claim())
+        job = models.ProvisioningJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (models.ProvisioningJob.STATUS.queued, 1))
+        self.assertEqual(models.ProvisioningJob.objects.claim(), None)
+        self.assertEqual(self.registered, [])
+
+        self.remote = object()
+        models.ProvisioningJob.objects.update(run_after=datetime.datetime.now())
+        executor.run_job(models.ProvisioningJob.objects.claim())
+        job = models.ProvisioningJob.objects.get()
+        self.assertEqual(job.status, models.ProvisioningJob.STATUS.completed)
+        self.assertEqual(self.registered, ['new'])
+        self.assertEqual([(p['action'], p['state']) for p in job.progress], [('register', 'done')])
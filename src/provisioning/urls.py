@@ -32,10 +32,13 @@ urlpatterns = patterns(
     url(r'^software$', views.TenantSoftwareListView.as_view(), name='software-list'),
     url(r'^software/(?P<pk>\d+)$', views.TenantSoftwareView.as_view(), name='software-detail'),
     url(r'^user/(?P<pk>\d+)$', views.UserProvisionView.as_view(), name='user-provision'),
+    url(r'^jobs/(?P<pk>\d+)$', views.ProvisioningJobView.as_view(),
+        name='provisioning-job-detail'),
     url(r'^user/(?P<pk>\d+)/inventory_entries$',
         views.UserInventoryEntryListView.as_view(), name='user-inventory-entries'),
     url(r'^available_devices$', views.AvailableDeviceListView.as_view(),
         name='available-device-list'),
+    url(r'^last_seen$', views.LastSeenSummaryListView.as_view(), name='last-seen-list'),
     url(r'^inventory_entries$', views.InventoryEntryListView.as_view(),
         name='inventory-entries-list'),
     url(r'^user/(?P<pk>\d+)/inventory_entries/latest$',
@@ -16,16 +16,20 @@
 # limitations under the License.
 
 
+from dateutil.parser import parse
 from django.contrib.contenttypes.models import ContentType
 from rest_framework import generics
 from rest_framework import permissions as rest_permissions
+from rest_framework import status
+from rest_framework.exceptions import ParseError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
 
 from tenants import permissions
 from tenants.models import TenantService, User
-from google import Client
+from devices import AvailableDeviceCache, DeviceModelMatcher, fetch_from_providers
+from google import get_client
 import models
 import serializers
 from models import TenantAsset
@@ -105,39 +109,114 @@ class UserProvisionView(generics.RetrieveUpdateAPIView):
     serializer_class = serializers.UserProvisionSerializer
     model = User
 
+    def update(self, request, *args, **kw):
+        # Changes are applied by the provisioning worker; the response points
+        # to the job that reports their progress.
+        partial = kw.pop('partial', False)
+        self.object = self.get_object()
+        serializer = self.get_serializer(
+            self.object, data=request.DATA, files=request.FILES, partial=partial
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        job = models.ProvisioningJob.objects.enqueue(
+            self.object, request.user, self.object._provision_data
+        )
+        data = serializers.ProvisioningJobSerializer(
+            job, context=self.get_serializer_context()
+        ).data
+        return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': data['url']})
+
+
+class ProvisioningJobView(generics.RetrieveAPIView):
+    permission_classes = (permissions.IsTenantPrimaryContact, )
+    serializer_class = serializers.ProvisioningJobSerializer
+
+    def get_queryset(self, *args, **kw):
+        return models.ProvisioningJob.objects.filter(user__tenant=self.request.user.tenant)
+
 
 class UserProvisionStatusListView(generics.ListAPIView):
     permission_classes = (permissions.IsTenantPrimaryContact, )
     serializer_class = serializers.UserSummarySerializer
+    paginate_by_param = 'page_size'
 
     def get_queryset(self, *args, **kw):
         return self.request.user.tenant.user_set.all()
 
+    def paginate_queryset(self, *args, **kw):
+        self.page = super(UserProvisionStatusListView, self).paginate_queryset(*args, **kw)
+        return self.page
+
+    def get_serializer_context(self, *args, **kw):
+        context = super(UserProvisionStatusListView, self).get_serializer_context(*args, **kw)
+        page = getattr(self, 'page', None)
+        users = page.object_list if page is not None else getattr(self, 'object_list', None)
+        if users is not None:
+            # Evaluates the page once; the serializer renders the same rows
+            # and the summary queries filter on plain ids, not a subquery.
+            context['provision_summary'] = serializers.make_provision_summary(
+                [user.pk for user in users]
+            )
+        return context
+
+
+def fetch_available_devices(tenant):
+    airwatch_item = models.AirWatch.objects.get(tenant=tenant)
+    return fetch_from_providers([
+        ('airwatch', airwatch_item.get_available_devices),
+        ('google', lambda: get_client(tenant).get_available_devices())
+    ])
+
+
+def load_device_assets(tenant):
+    # Devices named after Chrome are loaded as ChromeDevice, which is not
+    # matched against available devices.
+    return TenantAsset.objects.filter(
+        tenant=tenant, asset__device__isnull=False
+    ).exclude(asset__name__icontains='chrome').order_by('id').values_list('id', 'asset_id', 'asset__name')
+
 
 class AvailableDeviceListView(APIView):
     permission_classes = (permissions.IsTenantPrimaryContact, )
 
     def get(self, request, format=None):
         """
-        Return a list of all Available Devices.
+        Return all Available Devices, with a warning for every device
+        provider that could not be reached.
         """
         tenant = request.user.tenant
-        tenant_assets = TenantAsset.objects.filter(tenant=tenant)
-        tenant_assets = [
-            ta for ta in tenant_assets
-            if ta.asset.__subclassed__.__class__.__name__ == 'Device']
-        airwatch_item = models.AirWatch.objects.get(tenant=request.user.tenant)
-        google_client = Client(request.user.tenant)
-        google_devices = google_client.get_available_devices()
-        airwatch_devices = airwatch_item.get_available_devices()
-        devices = airwatch_devices + google_devices
-        for d in devices:
-            for ta in tenant_assets:
-                if ta.asset.name.lower() in d['model'].lower():
-                    d['tenant_asset_id'] = ta.id
-                    d['device_id'] = ta.asset_id
-
-        return Response(devices)
+        result = AvailableDeviceCache(tenant, fetch_available_devices).get()
+        DeviceModelMatcher.for_tenant(tenant, load_device_assets).annotate(result['devices'])
+        return Response(result)
+
+
+class LastSeenSummaryListView(generics.ListAPIView):
+    permission_classes = (permissions.IsTenantPrimaryContact, )
+    serializer_class = serializers.LastSeenSummarySerializer
+    paginate_by = 50
+
+    def get_queryset(self, *args, **kw):
+        qs = models.LastSeenSummary.objects.filter(
+            user__tenant=self.request.user.tenant
+        ).select_related('user', 'item_type').order_by('last_seen', 'id')
+
+        user = self.request.GET.get('user')
+        if user:
+            try:
+                qs = qs.filter(user__id=int(user))
+            except ValueError:
+                raise ParseError('user must be a user id')
+
+        seen_before = self.request.GET.get('before')
+        if seen_before:
+            try:
+                qs = qs.filter(last_seen__lt=parse(seen_before))
+            except (ValueError, OverflowError):
+                raise ParseError('before must be a date and time')
+
+        return qs
 
 
 class InventoryEntryListView(generics.ListCreateAPIView):
@@ -2,9 +2,40 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import threading
+from contextlib import contextmanager
+
 from django.db import models
 
 
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_sync():
+    # Saves made inside this block do not talk to the remote. Each changed
+    # object is synchronized once, with its latest state, when the block ends.
+    if getattr(_deferred, 'pending', None) is not None:
+        yield
+        return
+
+    _deferred.pending = {}
+    try:
+        yield
+        pending = _deferred.pending.values()
+    finally:
+        _deferred.pending = None
+
+    for obj, force_push, force_pull in pending:
+        before = (obj.last_remote_read, obj.last_remote_save)
+        obj._sync(force_push=force_push, force_pull=force_pull)
+        if (obj.last_remote_read, obj.last_remote_save) != before:
+            obj.__class__.objects.filter(pk=obj.pk).update(
+                last_remote_read=obj.last_remote_read,
+                last_remote_save=obj.last_remote_save
+                )
+
+
 class Synchronizable(models.Model):
     SYNCHRONIZABLE_ATTRIBUTES_MAP = {}
 
@@ -12,6 +43,23 @@ class Synchronizable(models.Model):
     last_remote_save = models.DateTimeField(null=True, editable=False)
     last_modified = models.DateTimeField(auto_now=True, editable=False)
 
+    def __init__(self, *args, **kw):
+        super(Synchronizable, self).__init__(*args, **kw)
+        self._reset_synchronizable_state()
+
+    def _synchronizable_values(self):
+        # Read from __dict__ so that deferred fields are not loaded
+        return dict(
+            (attr, self.__dict__.get(attr)) for attr in self.SYNCHRONIZABLE_ATTRIBUTES_MAP
+            )
+
+    def _reset_synchronizable_state(self):
+        self._synchronizable_snapshot = self._synchronizable_values()
+
+    @property
+    def has_synchronizable_changes(self):
+        return self._synchronizable_values() != self._synchronizable_snapshot
+
     @property
     def last_sync(self):
         if self.last_remote_read is not None and self.last_remote_save is not None:
@@ -38,6 +86,20 @@ class Synchronizable(models.Model):
         return self.last_remote_save is not None
 
     def sync(self, force_push=False, force_pull=False):
+        # Objects loaded from the database only need the remote when one of
+        # the mapped attributes changed since they were loaded or saved.
+        if not (force_push or force_pull or self.pk is None or self.has_synchronizable_changes):
+            return
+
+        pending = getattr(_deferred, 'pending', None)
+        if pending is not None:
+            _, pushed, pulled = pending.get(id(self), (None, False, False))
+            pending[id(self)] = (self, force_push or pushed, force_pull or pulled)
+            return
+
+        self._sync(force_push=force_push, force_pull=force_pull)
+
+    def _sync(self, force_push=False, force_pull=False):
         remote = self.get_remote()
         changed = (self._get_changed_attributes(remote_object=remote) != [])
         needs_pull = changed and self._needs_pull(remote)
@@ -60,6 +122,10 @@ class Synchronizable(models.Model):
             if getattr(self, local_attr) != getattr(remote, remote_attr)
             ]
 
+    def save(self, *args, **kw):
+        super(Synchronizable, self).save(*args, **kw)
+        self._reset_synchronizable_state()
+
     def get_remote(self):
         raise NotImplementedError
 
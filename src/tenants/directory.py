@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+# Every bound session holds an LDAPS connection to the directory server.
+# Domain controllers drop idle connections, so sessions that have not been
+# used for MAX_IDLE seconds are not handed out again but replaced.
+POOL_SIZE = 4
+MAX_IDLE = 300
+
+_FILTER_ESCAPES = [('\\', r'\5c'), ('*', r'\2a'), ('(', r'\28'), (')', r'\29'), ('\x00', r'\00')]
+
+
+def escape_filter_value(value):
+    # RFC 4515 escaping for values put into an LDAP search filter
+    for char, escaped in _FILTER_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def in_organizational_unit(dn, ou):
+    # Tenants can share a directory server, each with its users under its
+    # own OU, so entries are only ours when their DN has an OU=<ou> RDN.
+    rdns = [rdn.strip().lower() for rdn in re.split(r'(?<!\\),', dn or '')]
+    return ('ou=%s' % ou).lower() in rdns
+
+
+class DetachedEntry(object):
+    # Copy of the attributes of a directory entry. Entries read their
+    # attributes through the session they were found with, which must not be
+    # used any more once it went back to the pool.
+    def __init__(self, entry, attributes):
+        for attr in attributes:
+            setattr(self, attr, getattr(entry, attr, None))
+
+
+class SessionPool(object):
+    def __init__(self, make_session, size=POOL_SIZE, max_idle=MAX_IDLE):
+        self.make_session = make_session
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _checkout(self):
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                session, last_used = self._idle.pop()
+                if now - last_used < self.max_idle:
+                    return session
+                log.debug('Dropping LDAP session idle for %ds' % (now - last_used))
+        return self.make_session()
+
+    def _checkin(self, session):
+        with self._lock:
+            self._idle.append((session, time.time()))
+
+    @contextmanager
+    def session(self):
+        # A session that raised while in use is not trusted to be healthy and
+        # is dropped; the next checkout binds a new one.
+        with self._slots:
+            session = self._checkout()
+            try:
+                yield session
+            except Exception:
+                log.debug('Discarding LDAP session after error')
+                raise
+            self._checkin(session)
+
+    def clear(self):
+        with self._lock:
+            self._idle = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool_key(active_directory):
+    return (active_directory.full_url, active_directory.dn, active_directory.password)
+
+
+def get_pool(active_directory):
+    key = pool_key(active_directory)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SessionPool(active_directory.make_session)
+        return pool
+
+
+def discard_pool(active_directory):
+    with _pools_lock:
+        pool = _pools.pop(pool_key(active_directory), None)
+    if pool is not None:
+        pool.clear()
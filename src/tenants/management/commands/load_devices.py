@@ -19,7 +19,7 @@
 from django.core.management.base import BaseCommand
 from provisioning import models
 from optparse import make_option
-from provisioning.google import Client
+from provisioning.google import get_client
 # import pprint
 
 
@@ -40,7 +40,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         tenant = models.Tenant.objects.get(pk=options['tenant'])
-        google_client = Client(tenant)
+        google_client = get_client(tenant)
         all_devices = google_client.get_available_devices()
         self.stdout.write("")
         self.stdout.write("Get Google Devices")
@@ -55,7 +55,8 @@ class Command(BaseCommand):
         self.stdout.write("Get AirWatch Devices & Platform usage")
 
         airwatch_item = models.AirWatch.objects.get(tenant=tenant)
-        devices = airwatch_item.get_available_devices()
-        for device in devices:
+        inventory = airwatch_item.get_device_inventory()
+        self.stdout.write('%d devices enrolled' % len(inventory))
+        for device in inventory.available():
             self.stdout.write('%s (%s) user: %s' %
                               (device['model'], device['serial_number'], device['username']))
@@ -16,27 +16,30 @@
 # limitations under the License.
 
 
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 
-from litedesk.lib.active_directory.classes.base import Company
-
 from tenants import models
+from tenants.sync import DirectorySync
 
 
 class Command(BaseCommand):
     help = 'For all tenants with AD credentials, load the user table'
 
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--full', dest='full', action='store_true', default=False,
+            help='read all users instead of those changed since the last run'
+            ),
+    )
+
     def handle(self, *fixture_labels, **options):
         user_class = get_user_model()
         admin = user_class.objects.filter(is_superuser=True)[0]
-        for ad in models.ActiveDirectory.objects.all():
-            session = ad.make_session()
-            for company in Company.search(session, query='(ou=%s)' % ad.ou):
-                for remote_user in company.users:
-                    username = remote_user.s_am_account_name
-                    local_user = models.User.objects.filter(username=username)
-                    if local_user.exists():
-                        models.User.merge(local_user.get(), remote_user, editor=admin)
-                    else:
-                        models.User.load(remote_user, editor=admin, tenant=ad.tenant)
+        for ad in models.ActiveDirectory.objects.select_related('tenant'):
+            result = DirectorySync(ad, editor=admin, full=options['full']).run()
+            self.stdout.write('%s: %d created, %d updated' % (
+                ad.tenant, len(result.created), len(result.updated)
+                ))
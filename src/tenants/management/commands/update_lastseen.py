@@ -15,29 +15,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
+import datetime
 from optparse import make_option
 
 from apiclient import errors
-from apiclient.discovery import build
 from dateutil import parser
-from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
-from oauth2client.client import SignedJwtAssertionCredentials
-import httplib2
 import pytz
 
-from provisioning import models
+from contrib.concurrency import fan_out, DEFAULT_CONCURRENCY
+from provisioning import google, models, okta
 
 
 class Command(BaseCommand):
-    # Check
-    # https://developers.google.com/admin-sdk/directory/v1/guides/authorizing
-    # for all available scopes
-    OAUTH_SCOPE = ['https://www.googleapis.com/auth/admin.directory.user',
-                   'https://www.googleapis.com/auth/admin.directory.device.chromeos']
-
     help = 'Updates the last seen timestamp for provisioned services.'
     option_list = BaseCommand.option_list + (
         make_option('--skip-okta',
@@ -59,6 +50,30 @@ class Command(BaseCommand):
                     dest='tenant',
                     default=1,
                     help='Tenant id to do this for. Default=1'),
+        make_option('--chunk-size',
+                    dest='chunk-size',
+                    default=models.LastSeenEvent.INGEST_BATCH_SIZE,
+                    help='Events written per bulk insert. Default=%d' % (
+                        models.LastSeenEvent.INGEST_BATCH_SIZE)),
+        make_option('--concurrency',
+                    dest='concurrency',
+                    default=DEFAULT_CONCURRENCY,
+                    help='Parallel remote lookups per service. Default=%d' % (
+                        DEFAULT_CONCURRENCY)),
+        make_option('--okta-lookback-days',
+                    dest='okta-lookback-days',
+                    default=okta.SSO_LOOKBACK_DAYS,
+                    help='Days of Okta SSO events searched for applications '
+                         'not seen before. Default=%d' % okta.SSO_LOOKBACK_DAYS),
+        make_option('--okta-concurrency',
+                    dest='okta-concurrency',
+                    default=None,
+                    help='Parallel Okta lookups. Default=--concurrency'),
+        make_option('--airwatch-page-size',
+                    dest='airwatch-page-size',
+                    default=models.AirWatch.DEVICE_PAGE_SIZE,
+                    help='Devices fetched per AirWatch request. Default=%d' % (
+                        models.AirWatch.DEVICE_PAGE_SIZE)),
     )
 
     def _parseDateTime(self, stamp):
@@ -76,6 +91,7 @@ class Command(BaseCommand):
         google_software = models.Software.objects.get(name='Google Account')
         device_contenttype = ContentType.objects.get_for_model(
             models.Device)
+        events = models.LastSeenEventBuffer(batch_size=int(options['chunk-size']))
 
         self.stdout.write("Okta users in database.")
         user_dict = {}
@@ -96,7 +112,7 @@ class Command(BaseCommand):
                     user_dict[okta_username].update(
                         {'okta_id': okta_user['id']})
                     if okta_user['lastLogin']:
-                        models.LastSeenEvent.objects.create(
+                        events.add(
                             user=user_dict[okta_username]['user'],
                             item_type=okta_item_type,
                             object_id=okta_item.id,
@@ -108,75 +124,82 @@ class Command(BaseCommand):
             self.stdout.write("")
             self.stdout.write("Get Okta SSO events.")
             okta_client = okta_item.get_client()
+            application_ids = dict(
+                (tsa.asset_id, tsa.get('application_id'))
+                for tsa in models.TenantServiceAsset.objects.filter(service=okta_item)
+            )
+            software_names = dict(
+                models.Software.objects.values_list('id', 'name'))
 
             usersoftwares = models.UserProvisionable.objects.filter(
                 user__tenant=tenant,
                 item_type=software_contenttype,
                 service=okta_item).exclude(
-                object_id=google_software.id)
+                object_id=google_software.id).select_related('user__tenant')
                 # Google accoint login is done below directly from google
-            for usersoftware in usersoftwares:
-                oktatenantservice = usersoftware.item.tenantserviceasset_set.get(
-                    service=okta_item)
-                event = okta_client.last_sso_event(
-                    user_dict[usersoftware.user.tenant_email]['okta_id'],
-                    oktatenantservice.get('application_id'))
+            lookups = [
+                (usersoftware,
+                 user_dict[usersoftware.user.tenant_email].get('okta_id'),
+                 application_ids.get(usersoftware.object_id))
+                for usersoftware in usersoftwares
+                if usersoftware.user.tenant_email in user_dict
+            ]
+            # Applications seen before are only searched from then on, the
+            # others as far back as the look back window goes.
+            lookback_start = datetime.datetime.utcnow() - datetime.timedelta(
+                days=int(options['okta-lookback-days']))
+            last_seen = dict(
+                ((user_id, object_id), seen) for user_id, object_id, seen in
+                models.LastSeenSummary.objects.filter(
+                    user__tenant=tenant, item_type=software_contenttype
+                ).values_list('user_id', 'object_id', 'last_seen')
+            )
+
+            def last_sso_event(lookup):
+                usersoftware = lookup[0]
+                since = max(lookback_start, last_seen.get(
+                    (usersoftware.user_id, usersoftware.object_id), lookback_start))
+                return okta_client.last_sso_event(lookup[1], lookup[2], since=since)
+
+            results = fan_out(
+                last_sso_event,
+                [l for l in lookups if l[1] and l[2]],
+                concurrency=int(options['okta-concurrency'] or options['concurrency'])
+            )
+            for result in results:
+                usersoftware = result.item[0]
+                event = result.value
+                if result.error is not None:
+                    self.stderr.write('%s - %s: %s' % (
+                        usersoftware.user.tenant_email,
+                        software_names.get(usersoftware.object_id), result.error))
                 if event:
-                    models.LastSeenEvent.objects.create(
+                    events.add(
                         user=usersoftware.user,
                         item_type=software_contenttype,
                         object_id=usersoftware.object_id,
                         last_seen=self._parseDateTime(event['published']))
                     self.stdout.write(
                         '%s - %s -> %s' % (usersoftware.user.tenant_email,
-                                           usersoftware.item.name,
+                                           software_names.get(usersoftware.object_id),
                                            event and event['published'] or "never"))
 
+            for family, stats in okta_client.rate_limiter.stats.items():
+                self.stdout.write('Okta %s: waited %.1fs on rate limits, throttled %d times' % (
+                    family, stats['wait_time'], stats['throttled']))
+
         if not options['skip-google']:
             # Get Google lastseen
-            google_tenant_asset = tenant.tenantasset_set.get(
-                asset__name='Google Account')
-
-            # Run through the OAuth flow and retrieve credentials
-            certificate_file_path = os.path.join(
-                settings.CERTIFICATES_DIR, google_tenant_asset.get('CERTIFICATE_FILE_NAME')
-                )
-            with open(certificate_file_path) as f:
-                private_key = f.read()
-            credentials = SignedJwtAssertionCredentials(
-                google_tenant_asset.get('CLIENT_EMAIL'),
-                private_key,
-                scope=self.OAUTH_SCOPE,
-                sub=google_tenant_asset.get('ADMINISTRATOR')
-            )
-
-            # Create an httplib2.Http object and authorize it with our
-            # credentials
-            http = httplib2.Http()
-            http = credentials.authorize(http)
-            directory_service = build('admin', 'directory_v1', http=http)
+            google_client = google.get_client(tenant)
 
             # Get Google Account lastseen information
-            all_users = []
-            page_token = None
-            params = {'customer': 'my_customer'}
-
             self.stdout.write("")
             self.stdout.write("Get Google Account users")
-            while True:
-                try:
-                    if page_token:
-                        params['pageToken'] = page_token
-                    current_page = directory_service.users().list(
-                        **params).execute()
-
-                    all_users.extend(current_page['users'])
-                    page_token = current_page.get('nextPageToken')
-                    if not page_token:
-                        break
-                except errors.HttpError as error:
-                    self.stderr.write('An error occurred: %s' % error)
-                    break
+            try:
+                all_users = google_client.get_users()
+            except errors.HttpError as error:
+                self.stderr.write('An error occurred: %s' % error)
+                all_users = []
 
             for user in all_users:
                 if user['lastLoginTime'] == '1970-01-01T00:00:00.000Z':
@@ -186,7 +209,7 @@ class Command(BaseCommand):
                         user__tenant=tenant,
                         item_type=software_contenttype,
                         object_id=google_software.id).exists():
-                    models.LastSeenEvent.objects.create(
+                    events.add(
                         user=user_dict[user['primaryEmail']]['user'],
                         item_type=software_contenttype,
                         object_id=google_software.id,
@@ -195,23 +218,11 @@ class Command(BaseCommand):
                         user['primaryEmail'] + " - " + user['lastLoginTime'])
 
             # Get Google Device lastseen information
-            all_devices = []
-            page_token = None
-            params = {'customerId': 'my_customer'}
-
-            while True:
-                try:
-                    if page_token:
-                        params['pageToken'] = page_token
-                    current_page = directory_service.chromeosdevices().list(
-                        **params).execute()
-                    all_devices.extend(current_page['chromeosdevices'])
-                    page_token = current_page.get('nextPageToken')
-                    if not page_token:
-                        break
-                except errors.HttpError as error:
-                    self.stderr.write('An error occurred: %s' % error)
-                    break
+            try:
+                all_devices = google_client.get_chromeos_devices()
+            except errors.HttpError as error:
+                self.stderr.write('An error occurred: %s' % error)
+                all_devices = []
 
             self.stdout.write("")
             self.stdout.write("Get Google Devices")
@@ -222,7 +233,7 @@ class Command(BaseCommand):
                         user__tenant=tenant,
                         item_type=device_contenttype,
                         object_id=chromebook_device.id).exists():
-                    models.LastSeenEvent.objects.create(
+                    events.add(
                         user=user_dict[device['annotatedUser']]['user'],
                         item_type=device_contenttype,
                         object_id=chromebook_device.id,
@@ -237,42 +248,46 @@ class Command(BaseCommand):
             self.stdout.write("Get AirWatch Devices & Platform usage")
 
             airwatch_item = models.AirWatch.objects.get(tenant=tenant)
-            airwatch_client = airwatch_item.get_client()
-            endpoint = 'mdm/devices/search'
-
             iPad_device = models.Device.objects.get(name='iPad')
             iPhone_device = models.Device.objects.get(name='iPhone')
             airwatch_item_type = ContentType.objects.get_for_model(airwatch_item)
 
             airwatch_users = models.User.objects.filter(services=airwatch_item)
+
+            inventory = airwatch_item.get_device_inventory(
+                page_size=int(options['airwatch-page-size']))
+            self.stdout.write("%d AirWatch devices" % len(inventory))
             for user in airwatch_users:
-                response = airwatch_client.call_api(
-                    'GET', endpoint, params={'user': user.username})
-                response.raise_for_status()
-                if response.status_code == 200:
-                    devices = response.json().get('Devices')
-                    newest_seen = parser.parse(devices[0]['LastSeen'])
-                    for device in devices:
-                        seen = parser.parse(device['LastSeen'])
-                        if seen > newest_seen:
-                            newest_seen = seen
-                        if device['Model'].startswith(iPad_device.name):
-                            device_item = iPad_device
-                        elif device['Model'].startswith(iPhone_device.name):
-                            device_item = iPhone_device
-                        else:
-                            device_item = None
-                        models.LastSeenEvent.objects.create(
-                            user=user,
-                            item_type=device_contenttype,
-                            object_id=device_item.id,
-                            last_seen=seen)
-                        self.stdout.write(
-                            "%s - %s -> %s" % (user, device['SerialNumber'],
-                                               device['LastSeen']))
-                    self.stdout.write("%s -> %s" % (user, newest_seen))
-                    models.LastSeenEvent.objects.create(
+                devices = inventory.for_user(user.username)
+                if not devices:
+                    continue
+                newest_seen = parser.parse(devices[0]['LastSeen'])
+                for device in devices:
+                    seen = parser.parse(device['LastSeen'])
+                    if seen > newest_seen:
+                        newest_seen = seen
+                    if device['Model'].startswith(iPad_device.name):
+                        device_item = iPad_device
+                    elif device['Model'].startswith(iPhone_device.name):
+                        device_item = iPhone_device
+                    else:
+                        continue
+                    events.add(
                         user=user,
-                        item_type=airwatch_item_type,
-                        object_id=airwatch_item.id,
-                        last_seen=newest_seen)
+                        item_type=device_contenttype,
+                        object_id=device_item.id,
+                        last_seen=seen)
+                    self.stdout.write(
+                        "%s - %s -> %s" % (user, device['SerialNumber'],
+                                           device['LastSeen']))
+                self.stdout.write("%s -> %s" % (user, newest_seen))
+                events.add(
+                    user=user,
+                    item_type=airwatch_item_type,
+                    object_id=airwatch_item.id,
+                    last_seen=newest_seen)
+
+        self.stdout.write("")
+        self.stdout.write("%d events observed" % len(events))
+        created = events.flush()
+        self.stdout.write("%d new events recorded" % len(created))
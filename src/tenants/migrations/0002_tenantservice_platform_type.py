@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tenantservice',
+            name='platform_type',
+            field=models.CharField(default=b'', max_length=20, editable=False, db_index=True, blank=True, choices=[(b'mobile', b'mobile'), (b'web', b'web'), (b'windows', b'windows')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='tenantservice',
+            name='slug',
+            field=models.SlugField(default=b'', max_length=100, editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
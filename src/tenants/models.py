@@ -36,9 +36,10 @@ from litedesk.lib.active_directory.session import Session
 from litedesk.lib.active_directory.classes.base import Company, User as ActiveDirectoryUser
 from audit.models import Trackable, UntrackableChangeError
 from audit.signals import pre_trackable_model_delete
+from contrib.models import Subclassable
 from syncremote.models import Synchronizable
 
-import tasks
+import directory
 
 log = logging.getLogger(__name__)
 
@@ -69,11 +70,17 @@ class ServiceMeta(object):
 
 
 class ActiveDirectory(models.Model):
+    USER_ATTRIBUTES = [
+        's_am_account_name', 'given_name', 'sn', 'mail', 'display_name', 'telephone_number',
+        'when_changed', 'distinguished_name'
+        ]
+
     url = models.CharField(max_length=300)
     domain = models.CharField(max_length=200)
     ou = models.CharField(max_length=200)
     username = models.CharField(max_length=80)
     password = models.CharField(max_length=1000)
+    users_changed_since = models.DateTimeField(null=True, blank=True, editable=False)
 
     @property
     def full_url(self):
@@ -89,23 +96,50 @@ class ActiveDirectory(models.Model):
     def make_session(self):
         return Session(self.full_url, self.dn, self.password, True)
 
-    def find_company(self):
-        session = self.make_session()
-        try:
-            query_results = Company.search(session, query='(ou=%s)' % self.ou)
-            return query_results[0]
-        except IndexError:
-            return None
+    def session(self):
+        # Borrows a bound session from the pool shared by all users of this
+        # directory, for use in a with block.
+        return directory.get_pool(self).session()
 
-    def find_user(self, username):
+    def find_company(self, session):
+        query = '(ou=%s)' % directory.escape_filter_value(self.ou)
         try:
-            session = self.make_session()
-            query_results = Company.search(session, query='(ou=%s)' % self.ou)
-            company = query_results[0]
-            return [u for u in company.users if u.s_am_account_name == username].pop()
+            return Company.search(session, query=query)[0]
         except IndexError:
             return None
 
+    def in_company(self, remote_user):
+        return directory.in_organizational_unit(remote_user.distinguished_name, self.ou)
+
+    def _find_user(self, username, session):
+        query = '(sAMAccountName=%s)' % directory.escape_filter_value(username)
+        for remote_user in ActiveDirectoryUser.search(session, query=query):
+            if self.in_company(remote_user):
+                return remote_user
+        return None
+
+    def find_user(self, username, session=None):
+        # Without a session, the user is looked up on a pooled one and only
+        # a copy of its attributes is returned.
+        if session is not None:
+            return self._find_user(username, session)
+        with self.session() as session:
+            remote_user = self._find_user(username, session)
+            if remote_user is None:
+                return None
+            return directory.DetachedEntry(remote_user, self.USER_ATTRIBUTES)
+
+    def save(self, *args, **kw):
+        if self.pk is not None:
+            stored = ActiveDirectory.objects.filter(pk=self.pk).first()
+            if stored is not None and directory.pool_key(stored) != directory.pool_key(self):
+                directory.discard_pool(stored)
+        return super(ActiveDirectory, self).save(*args, **kw)
+
+    def delete(self, *args, **kw):
+        directory.discard_pool(self)
+        return super(ActiveDirectory, self).delete(*args, **kw)
+
     def __unicode__(self):
         return '%s/%s (%s)' % (self.full_url, self.domain, self.ou)
 
@@ -122,11 +156,7 @@ class Tenant(TimeStampedModel):
         return self.active_directory.make_session()
 
     def get_service(self, service_slug):
-        services = self.tenantservice_set.select_subclasses()
-        try:
-            return [s for s in services if s.service_slug() == service_slug].pop()
-        except IndexError:
-            return None
+        return self.tenantservice_set.filter(slug=service_slug).select_subclasses().last()
 
     def __unicode__(self):
         return self.name
@@ -143,11 +173,12 @@ class TenantItem(models.Model):
         return 'Item %s from %s' % (self.item, self.tenant)
 
 
-class TenantService(models.Model):
+class TenantService(Subclassable, models.Model):
     PLATFORM_TYPE_CHOICES = Choices('mobile', 'web', 'windows')
     PLATFORM_TYPES = [p[0] for p in PLATFORM_TYPE_CHOICES]
     ACTIVE_DIRECTORY_CONTROLLER = False
     EXPENSE_CATEGORY = 'platform'
+    PROVISIONING_CONCURRENCY = 4
 
     DEACTIVATION_EXCEPTION = Exception
 
@@ -156,10 +187,11 @@ class TenantService(models.Model):
     tenant = models.ForeignKey(Tenant)
     is_active = models.BooleanField(default=True)
     api_token = models.CharField(max_length=128)
-
-    @property
-    def __subclassed__(self):
-        return TenantService.objects.get_subclass(id=self.id)
+    platform_type = models.CharField(
+        max_length=20, choices=PLATFORM_TYPE_CHOICES, db_index=True, blank=True, default='',
+        editable=False
+        )
+    slug = models.SlugField(max_length=100, blank=True, default='', editable=False)
 
     @property
     def service(self):
@@ -167,7 +199,7 @@ class TenantService(models.Model):
 
     @property
     def type(self):
-        return self.__subclassed__.PLATFORM_TYPE
+        return getattr(self.__class__, 'PLATFORM_TYPE', None) or self.platform_type
 
     @property
     def name(self):
@@ -181,13 +213,31 @@ class TenantService(models.Model):
         raise NotImplementedError
 
     def activate(self, user, editor=None):
-        user.services.add(self)
+        self.activate_remote(user)
+        self.record_activation(user, editor=editor)
 
     def deactivate(self, user, editor=None):
         log.debug('Deactivating user %s on %s' % (user, self))
+        assets = self.provisioned_assets(user)
+        self.deactivate_remote(user, assets)
+        self.record_deactivation(user, assets, editor=editor)
+
+    # As with assets, the remote half of (de)activation only talks to the
+    # service and may run concurrently; the record half only touches the
+    # local database.
+    def activate_remote(self, user):
+        pass
+
+    def record_activation(self, user, editor=None):
+        user.services.add(self)
+
+    def provisioned_assets(self, user):
+        return [up.item for up in user.userprovisionable_set.filter(service=self)]
+
+    def deactivate_remote(self, user, assets):
         service_user = self.get_service_user(user)
-        for up in user.userprovisionable_set.filter(service=self):
-            up.item.deprovision(self, user, editor=editor)
+        for asset in assets:
+            asset.deprovision_remote(self, user)
 
         if service_user is not None:
             try:
@@ -195,25 +245,41 @@ class TenantService(models.Model):
             except self.__class__.DEACTIVATION_EXCEPTION:
                 log.info('Trying to deactivate user %s, which is not active' % user)
 
+    def record_deactivation(self, user, assets, editor=None):
+        for asset in assets:
+            asset.record_deprovision(self, user, editor=editor)
         user.services.remove(self)
 
+    def asset_metadata(self, asset):
+        # Kept on the instance, so that remote calls running on other threads
+        # find the metadata looked up (or created) beforehand.
+        metadata = self.__dict__.setdefault('_asset_metadata', {})
+        if asset.pk not in metadata:
+            metadata[asset.pk], _ = self.tenantserviceasset_set.get_or_create(asset=asset)
+        return metadata[asset.pk]
+
     def get_service_user(self, user):
         raise NotImplementedError
 
     def validate_unique(self, exclude=None):
-        tenant_services = self.tenant.tenantservice_set.select_subclasses()
+        tenant_services = TenantService.objects.filter(tenant_id=self.tenant_id)
         if self.pk is not None:
             tenant_services = tenant_services.exclude(pk=self.pk)
 
-        active_services = tenant_services.filter(is_active=True)
-        if self.is_active and self.type in [s.type for s in active_services]:
+        active_services = tenant_services.filter(is_active=True, platform_type=self.type)
+        if self.is_active and active_services.exists():
             raise ValidationError('Active %s service already exists' % self.type)
 
         super(TenantService, self).validate_unique(exclude=None)
 
+    def save(self, *args, **kw):
+        if hasattr(self.__class__, 'PLATFORM_TYPE'):
+            self.platform_type = self.PLATFORM_TYPE
+            self.slug = self.service_slug()
+        return super(TenantService, self).save(*args, **kw)
+
     def __unicode__(self):
-        subclassed = TenantService.objects.get_subclass(id=self.id)
-        return '%s service for %s' % (subclassed.name, self.tenant)
+        return '%s service for %s' % (self.__subclassed__.name, self.tenant)
 
     @classmethod
     def get_serializer_data(self, **data):
@@ -238,7 +304,7 @@ class TenantService(models.Model):
             user = kw.get('instance')
             for service in user.tenant.tenantservice_set.select_subclasses():
                 if service.is_active_directory_controller:
-                    tasks.register_user_in_provisioning_service(service, user)
+                    service.schedule_registration(user)
 
     @staticmethod
     def get_available():
@@ -280,13 +346,13 @@ class User(Trackable, Synchronizable):
 
     def push(self):
         log.info('Pushing user %s' % self)
-        with transaction.atomic():
-            remote_user = self.get_remote()
-            session = self.tenant.get_active_directory_session()
+        active_directory = self.tenant.active_directory
+        with transaction.atomic(), active_directory.session() as session:
+            remote_user = active_directory.find_user(self.username, session=session)
             if remote_user is None:
                 remote_user = ActiveDirectoryUser(
                     session,
-                    parent=self.tenant.active_directory.find_company(),
+                    parent=active_directory.find_company(session=session),
                     given_name=self.first_name,
                     sn=self.last_name,
                     s_am_account_name=self.username,
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from litedesk.lib.active_directory.classes.base import User as ActiveDirectoryUser
+from audit.models import AuditLogEntry
+
+import directory
+from models import TenantService, User
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+WHEN_CHANGED_FORMAT = '%Y%m%d%H%M%S.0Z'
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for idx in xrange(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+class DirectorySync(object):
+    # Brings the users of one tenant in line with its Active Directory. Only
+    # entries changed since the last run are read (whenChanged is kept on the
+    # ActiveDirectory as a high-water mark) and the local side is written in
+    # bulk, without the per-user round trip of Synchronizable.sync.
+
+    def __init__(self, active_directory, editor, full=False):
+        self.active_directory = active_directory
+        self.tenant = active_directory.tenant
+        self.editor = editor
+        self.full = full
+        self.created = []
+        self.updated = []
+
+    def fetch(self, session):
+        since = self.active_directory.users_changed_since
+        if self.full or since is None:
+            company = self.active_directory.find_company(session=session)
+            return company.users if company is not None else []
+        query = '(&(sAMAccountName=*)(whenChanged>=%s))' % directory.escape_filter_value(
+            since.strftime(WHEN_CHANGED_FORMAT)
+        )
+        # The search covers the whole directory, which other tenants share;
+        # only users under this tenant's OU are ours, as with company.users.
+        return [
+            remote_user for remote_user in ActiveDirectoryUser.search(session, query=query)
+            if self.active_directory.in_company(remote_user)
+        ]
+
+    def _remote_fields(self, remote_user):
+        return dict(
+            (local_attr, getattr(remote_user, remote_attr))
+            for local_attr, remote_attr in User.SYNCHRONIZABLE_ATTRIBUTES_MAP.items()
+            if local_attr != 'username'
+        )
+
+    def _existing_users(self, usernames):
+        existing = {}
+        for batch in chunks(usernames):
+            for user in self.tenant.user_set.filter(username__in=batch):
+                existing[user.username] = user
+        return existing
+
+    def apply(self, remote_users):
+        remote_users = dict((r.s_am_account_name, r) for r in remote_users)
+        existing = self._existing_users(remote_users.keys())
+        now = datetime.datetime.now()
+        user_type = ContentType.objects.get_for_model(User)
+
+        new_users = []
+        audit_entries = []
+        with transaction.atomic():
+            for username, remote_user in remote_users.items():
+                fields = self._remote_fields(remote_user)
+                local_user = existing.get(username)
+                if local_user is None:
+                    new_users.append(User(
+                        username=username, tenant=self.tenant, last_remote_read=now, **fields
+                    ))
+                    continue
+
+                # Same rule as Synchronizable.merge: local edits made after
+                # the remote change win.
+                if local_user.last_modified > User.get_remote_last_modified(remote_user):
+                    continue
+                changed = dict(
+                    (attr, value) for attr, value in fields.items()
+                    if getattr(local_user, attr) != value
+                )
+                if not changed:
+                    continue
+                original = local_user._trackable_attributes
+                User.objects.filter(pk=local_user.pk).update(
+                    last_remote_read=now, last_modified=now, **changed
+                )
+                audit_entries.append(AuditLogEntry(
+                    edited_by=self.editor, content_type=user_type,
+                    object_id=local_user.pk, data=original
+                ))
+                self.updated.append(local_user)
+
+            User.objects.bulk_create(new_users, batch_size=BATCH_SIZE)
+            self.created = list(self._existing_users([u.username for u in new_users]).values())
+            audit_entries.extend(
+                AuditLogEntry(edited_by=self.editor, content_type=user_type, object_id=user.pk)
+                for user in self.created
+            )
+            AuditLogEntry.objects.bulk_create(audit_entries, batch_size=BATCH_SIZE)
+
+            if remote_users:
+                self.active_directory.users_changed_since = max(
+                    User.get_remote_last_modified(r) for r in remote_users.values()
+                )
+                self.active_directory.save()
+
+        # Bulk inserts skip post_save, so new users are registered on the
+        # tenant services here, the same way single saves do.
+        for user in self.created:
+            TenantService.on_user_creation(sender=User, instance=user, created=True)
+
+    def run(self):
+        with self.active_directory.session() as session:
+            remote_users = self.fetch(session)
+            self.apply(remote_users)
+        log.info('Synced %s: %d created, %d updated' % (
+            self.active_directory, len(self.created), len(self.updated)
+        ))
+        return self
@@ -1,18 +1,93 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import heapq
+import itertools
 import logging
+import threading
 import time
 
+from django.db import connection
+
 
 log = logging.getLogger(__name__)
 
+SCHEDULER_WORKERS = 4
+
+
+class RetryScheduler(object):
+    # Runs deferred calls on a small pool of daemon threads. A call returns
+    # None when it is done, or the number of seconds after which it wants to
+    # be run again.
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.workers = workers
+        self._queue = []
+        self._sequence = itertools.count()
+        self._pending = 0
+        self._threads = []
+        self._condition = threading.Condition()
+
+    def _start(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        for _ in xrange(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def schedule(self, func, delay=0):
+        with self._condition:
+            heapq.heappush(self._queue, (time.time() + delay, next(self._sequence), func))
+            self._pending += 1
+            self._start()
+            self._condition.notify_all()
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self._queue:
+                    due, _, func = self._queue[0]
+                    wait = due - time.time()
+                    if wait <= 0:
+                        heapq.heappop(self._queue)
+                        return func
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+
+    def _work(self):
+        while True:
+            func = self._next()
+            retry_in = None
+            try:
+                retry_in = func()
+            except Exception:
+                log.exception('Deferred call %s failed' % func)
+            finally:
+                connection.close()
+
+            with self._condition:
+                if retry_in is not None:
+                    heapq.heappush(self._queue, (time.time() + retry_in, next(self._sequence), func))
+                else:
+                    self._pending -= 1
+                self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        # Blocks until every scheduled call finished, including its retries
+        deadline = timeout and time.time() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = deadline and deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+scheduler = RetryScheduler()
+
 
-def register_user_in_provisioning_service(service, user):
-    # FIXME: The delay is necessary to avoid that services
-    # which depend on AD can get to see the newly created user
-    time.sleep(4)
-    try:
-        service.register(user)
-    except Exception, why:
-        log.warn('Failed when registering user %s on %s: %s' % (user, service, why))
+def wait_for_pending(timeout=None):
+    return scheduler.wait(timeout=timeout)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+from collections import namedtuple
+
+from django.db import connection
+from django.db import models as django_models
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from syncremote.models import deferred_sync
+
+import directory
+import factories
+import models
+import sync
+import tasks
+
+
+RemoteUser = namedtuple('RemoteUser', [
+    's_am_account_name', 'given_name', 'sn', 'mail', 'display_name', 'telephone_number',
+    'when_changed', 'distinguished_name'
+])
+
+
+def make_remote_user(username, given_name, when_changed, ou='Example'):
+    return RemoteUser(
+        username, given_name, 'Doe', '%s@example.org' % username, '%s Doe' % given_name, None,
+        when_changed.strftime('%Y%m%d%H%M%S.0Z'),
+        'CN=%s,OU=%s,DC=example,DC=org' % (username, ou)
+    )
+
+
+class FakeDirectory(object):
+    # Stands in for the directory server behind ActiveDirectoryUser.search
+    def __init__(self, entries):
+        self.entries = entries
+        self.queries = []
+
+    def search(self, session, query=None):
+        self.queries.append((session, query))
+        return [
+            entry for entry in self.entries
+            if 'sAMAccountName=*' in query or '(sAMAccountName=%s)' % entry.s_am_account_name in query
+        ]
+
+
+class RetrySchedulerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = tasks.RetryScheduler(workers=2)
+
+    def testRetriesUntilCallIsDone(self):
+        calls = []
+
+        def flaky():
+            calls.append(len(calls))
+            return 0.01 if len(calls) < 3 else None
+
+        self.scheduler.schedule(flaky)
+        self.assertTrue(self.scheduler.wait(timeout=5))
+        self.assertEqual(calls, [0, 1, 2])
+
+    def testDelayedCallsRunInOrderOfDueTime(self):
+        calls = []
+        self.scheduler.schedule(lambda: calls.append('late'), delay=0.1)
+        self.scheduler.schedule(lambda: calls.append('soon'))
+        self.assertTrue(self.scheduler.wait(timeout=5))
+        self.assertEqual(calls, ['soon', 'late'])
+
+
+class SessionPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.created = []
+
+        def make_session():
+            self.created.append(object())
+            return self.created[-1]
+        self.pool = directory.SessionPool(make_session, size=2)
+
+    def testSessionsAreReused(self):
+        with self.pool.session() as first:
+            pass
+        with self.pool.session() as second:
+            self.assertTrue(first is second)
+        self.assertEqual(len(self.created), 1)
+
+    def testFailedSessionsAreReplaced(self):
+        try:
+            with self.pool.session():
+                raise IOError('connection reset')
+        except IOError:
+            pass
+        with self.pool.session():
+            pass
+        self.assertEqual(len(self.created), 2)
+
+    def testIdleSessionsAreReplaced(self):
+        self.pool.max_idle = 0
+        with self.pool.session():
+            pass
+        with self.pool.session():
+            pass
+        self.assertEqual(len(self.created), 2)
+
+    def testFilterValuesAreEscaped(self):
+        self.assertEqual(directory.escape_filter_value('a*(b)\\'), r'a\2a\28b\29\5c')
+
+    def testOrganizationalUnitIsMatchedOnWholeRdns(self):
+        dn = r'CN=Doe\, John,OU=Acme,DC=example,DC=org'
+        self.assertTrue(directory.in_organizational_unit(dn, 'acme'))
+        self.assertFalse(directory.in_organizational_unit(dn, 'Acm'))
+        self.assertFalse(directory.in_organizational_unit(None, 'Acme'))
+
+
+class FindUserTestCase(TestCase):
+    def setUp(self):
+        changed = datetime.datetime(2014, 6, 1)
+        self.fake = FakeDirectory([
+            make_remote_user('jdoe', 'Other', changed, ou='Globex'),
+            make_remote_user('jdoe', 'Own', changed, ou='Acme')
+        ])
+        self.search = vars(models.ActiveDirectoryUser).get('search')
+        models.ActiveDirectoryUser.search = staticmethod(self.fake.search)
+        self.active_directories = [
+            models.ActiveDirectory.objects.create(
+                url='example.org', domain='EXAMPLE', ou=ou, username='admin', password='secret'
+            )
+            for ou in ['Acme', 'Initech']
+        ]
+        for active_directory in self.active_directories:
+            factories.TenantFactory(active_directory=active_directory)
+
+    def tearDown(self):
+        if self.search is None:
+            del models.ActiveDirectoryUser.search
+        else:
+            models.ActiveDirectoryUser.search = self.search
+        directory.discard_pool(self.active_directories[0])
+
+    def testOnlyUsersOfTheTenantOuAreFound(self):
+        acme, initech = self.active_directories
+        self.assertEqual(acme.find_user('jdoe', session='session').given_name, 'Own')
+        self.assertEqual(initech.find_user('jdoe', session='session'), None)
+
+    def testPooledLookupReturnsADetachedCopy(self):
+        acme = self.active_directories[0]
+        directory.discard_pool(acme)
+        acme.make_session = lambda: 'pooled'
+        remote_user = acme.find_user('jdoe')
+        self.assertTrue(isinstance(remote_user, directory.DetachedEntry))
+        self.assertEqual(
+            (remote_user.given_name, remote_user.distinguished_name),
+            ('Own', 'CN=jdoe,OU=Acme,DC=example,DC=org')
+        )
+        self.assertEqual(self.fake.queries[-1][0], 'pooled')
+
+
+class DirectorySyncTestCase(TestCase):
+    def setUp(self):
+        self.active_directory = models.ActiveDirectory.objects.create(
+            url='example.org', domain='EXAMPLE', ou='Example', username='admin', password='secret'
+        )
+        self.tenant = factories.TenantFactory(active_directory=self.active_directory)
+        self.editor = self.tenant.primary_contact
+
+        self.existing = factories.UserFactory.build(
+            tenant=self.tenant, username='jane', first_name='Janet'
+        )
+        django_models.Model.save(self.existing)
+        models.User.objects.filter(pk=self.existing.pk).update(
+            last_modified=datetime.datetime(2014, 1, 1)
+        )
+
+    def testCreatesAndUpdatesInBulk(self):
+        changed = datetime.datetime(2014, 6, 1, 12)
+        engine = sync.DirectorySync(self.active_directory, self.editor)
+        remote_users = [make_remote_user('jane', 'Jane', changed)] + [
+            make_remote_user('user%d' % idx, 'John', changed) for idx in xrange(20)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            engine.apply(remote_users)
+        self.assertLessEqual(len(queries), 16)
+
+        self.assertEqual(models.User.objects.get(pk=self.existing.pk).first_name, 'Jane')
+        self.assertEqual(
+            models.User.objects.filter(tenant=self.tenant, first_name='John').count(), 20
+        )
+        self.assertEqual(self.existing.changelog.count(), 1)
+        self.assertEqual(
+            models.ActiveDirectory.objects.get(pk=self.active_directory.pk).users_changed_since,
+            changed
+        )
+
+    def testIncrementalFetchIgnoresUsersOutsideTheOu(self):
+        changed = datetime.datetime(2014, 6, 1, 12)
+        fake = FakeDirectory([
+            make_remote_user('jane', 'Jane', changed),
+            make_remote_user('intruder', 'Eve', changed, ou='Globex')
+        ])
+        search = vars(models.ActiveDirectoryUser).get('search')
+        models.ActiveDirectoryUser.search = staticmethod(fake.search)
+        try:
+            self.active_directory.users_changed_since = datetime.datetime(2014, 5, 1)
+            engine = sync.DirectorySync(self.active_directory, self.editor)
+            remote_users = engine.fetch('session')
+        finally:
+            if search is None:
+                del models.ActiveDirectoryUser.search
+            else:
+                models.ActiveDirectoryUser.search = search
+        self.assertEqual([r.s_am_account_name for r in remote_users], ['jane'])
+        self.assertTrue('whenChanged>=20140501000000.0Z' in fake.queries[0][1])
+
+    def testLocalChangesNewerThanRemoteWin(self):
+        engine = sync.DirectorySync(self.active_directory, self.editor)
+        engine.apply([make_remote_user('jane', 'Jane', datetime.datetime(2013, 1, 1))])
+        self.assertEqual(engine.updated, [])
+        self.assertEqual(models.User.objects.get(pk=self.existing.pk).first_name, 'Janet')
+
+
+class SynchronizableChangesTestCase(TestCase):
+    def setUp(self):
+        self.tenant = factories.TenantFactory()
+        user = factories.UserFactory.build(tenant=self.tenant, username='synced')
+        django_models.Model.save(user)
+        self.user = models.User.objects.get(pk=user.pk)
+        self.remote_calls = []
+        self.user.get_remote = lambda: self.remote_calls.append('get_remote')
+        self.user.push = lambda: self.remote_calls.append('push')
+
+    def testSavingUnmappedFieldsSkipsRemote(self):
+        self.user.status = models.User.STATUS.active
+        self.user.save(editor=self.tenant.primary_contact)
+        self.assertEqual(self.remote_calls, [])
+
+    def testSavingMappedFieldsSyncs(self):
+        self.user.first_name = 'Changed'
+        self.user.save(editor=self.tenant.primary_contact)
+        self.assertEqual(self.remote_calls.count('push'), 1)
+        self.assertFalse(self.user.has_synchronizable_changes)
+
+    def testDeferredSyncPushesOnceAtTheEnd(self):
+        with deferred_sync():
+            for name in ['First', 'Second']:
+                self.user.first_name = name
+                self.user.save(editor=self.tenant.primary_contact)
+            self.assertEqual(self.remote_calls, [])
+        self.assertEqual(self.remote_calls.count('push'), 1)
+        self.assertTrue(models.User.objects.get(pk=self.user.pk).last_remote_save is not None)